@@ -12,6 +12,7 @@ from utils import data_tools as data
 from utils.logger import Logger
 from utils.utils import cast32, trunc, logit, get_shared_weights, get_shared_bias, get_shared_regression_weights, add_gaussian_noise, salt_and_pepper, load_from_config, fix_input_size, init_empty_file,\
     make_time_units_string
+from utils.function_cache import FunctionCache, source_digest
 
 def experiment(state, outdir_base='./'):
     rng.seed(1) #seed the numpy random generator
@@ -440,62 +441,6 @@ def experiment(state, outdir_base='./'):
     
     
     
-    logger.log("creating functions...")
-    t = time.time()
-    
-    gradient_init        =   T.grad(gsn_cost_init, gsn_params)              
-    gradient_buffer_init =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in gsn_params] 
-    m_gradient_init      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer_init, gradient_init)]
-    param_updates_init   =   [(param, param - learning_rate * mg) for (param, mg) in zip(gsn_params, m_gradient_init)]
-    gradient_buffer_updates_init = zip(gradient_buffer_init, m_gradient_init)
-    updates_init         =   OrderedDict(param_updates_init + gradient_buffer_updates_init)
-    
-    
-    gsn_f_learn_init     =   theano.function(inputs  = [X], 
-                                         updates = updates_init, 
-                                         outputs = [show_gsn_cost_init, gsn_init_error])
-    
-    gsn_f_cost_init      =   theano.function(inputs  = [X], 
-                                             outputs = [show_gsn_cost_init, gsn_init_error])
-    
-    
-    gradient        =   T.grad(gsn_cost, gsn_params)
-    gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in gsn_params]
-    m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-    param_updates   =   [(param, param - learning_rate * mg) for (param, mg) in zip(gsn_params, m_gradient)]
-    gradient_buffer_updates = zip(gradient_buffer, m_gradient)
-        
-    updates         =   OrderedDict(param_updates + gradient_buffer_updates)
-        
-    
-    gsn_f_cost      =   theano.function(inputs  = Xs, 
-                                      outputs = [show_gsn_cost, gsn_error])
-
-
-    gsn_f_learn     =   theano.function(inputs  = Xs, 
-                                        updates = updates, 
-                                        outputs = [show_gsn_cost, gsn_error])
-      
-    
-    regression_gradient        =   T.grad(regression_cost, regression_params)
-    regression_gradient_buffer =   [theano.shared(numpy.zeros(rparam.get_value().shape, dtype='float32')) for rparam in regression_params]
-    regression_m_gradient      =   [momentum * rgb + (cast32(1) - momentum) * rg for (rgb, rg) in zip(regression_gradient_buffer, regression_gradient)]
-    regression_param_updates   =   [(rparam, rparam - regression_learning_rate * rmg) for (rparam, rmg) in zip(regression_params, regression_m_gradient)]
-    regression_gradient_buffer_updates = zip(regression_gradient_buffer, regression_m_gradient)
-        
-    regression_updates         =   OrderedDict(regression_param_updates + regression_gradient_buffer_updates)
-    
-    regression_f_cost          =   theano.function(inputs = Xs, 
-                                                   outputs = [show_regression_cost, regression_error])
-        
-    regression_f_learn         =   theano.function(inputs  = Xs, 
-                                                  updates = regression_updates, 
-                                                  outputs = [show_regression_cost, regression_error])
-    
-    
-    logger.log("functions done. took "+make_time_units_string(time.time() - t)+".\n")
-    
-    
     ############################################################################################
     # Denoise some numbers : show number, noisy number, predicted number, reconstructed number #
     ############################################################################################   
@@ -505,17 +450,14 @@ def experiment(state, outdir_base='./'):
     predicted_X_chains_R, p_X_chains_R = build_sequence_graph(Xs_recon, noiseflag=False)
     predicted_X_chain_R = predicted_X_chains_R[-1]
     p_X_chain_R = p_X_chains_R[-1]
-    f_recon = theano.function(inputs = Xs_recon, outputs = [predicted_X_chain_R[-1], p_X_chain_R[-1]])
     
     # Now do the same but for the GSN in the initial run
-    p_X_chain_R = build_gsn_graph(X, noiseflag=False)
-    f_recon_init = theano.function(inputs=[X], outputs = p_X_chain_R[-1])
+    p_X_chain_R_init = build_gsn_graph(X, noiseflag=False)
 
 
     ############
     # Sampling #
     ############
-    f_noise = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
     # the input to the sampling function
     network_state_input     =   [X] + [T.fmatrix() for i in range(layers)]
    
@@ -531,14 +473,120 @@ def experiment(state, outdir_base='./'):
     logger.log("Performing one walkback in network state sampling.")
     update_layers(network_state_output, visible_pX_chain, noisy=True)
 
-    if layers == 1: 
-        f_sample_simple = theano.function(inputs = [X], outputs = visible_pX_chain[-1])
+
+    #############
+    # FUNCTIONS #
+    #############
+    # reuse the compiled functions of an earlier run with the same graph
+    function_cache = None
+    if getattr(state, 'cache_functions', True):
+        function_cache = FunctionCache(config={'model':                'Story1',
+                                               'N_input':              N_input,
+                                               'layers':               layers,
+                                               'walkbacks':            walkbacks,
+                                               'hidden_size':          state.hidden_size,
+                                               'sequence_window_size': sequence_window_size,
+                                               'hidden_act':           state.hidden_act,
+                                               'visible_act':          state.visible_act,
+                                               'cost_funct':           state.cost_funct,
+                                               'hidden_add_noise_sigma': state.hidden_add_noise_sigma,
+                                               'input_salt_and_pepper':  state.input_salt_and_pepper,
+                                               'noiseless_h1':         bool(state.noiseless_h1),
+                                               'input_sampling':       bool(state.input_sampling),
+                                               'regularize_weight':    state.regularize_weight,
+                                               'source':               source_digest(experiment, salt_and_pepper)},
+                                       logger=logger)
+    function_shared = gsn_params + regression_params + tau_flattened + [learning_rate, regression_learning_rate, momentum]
     
+    logger.log("creating functions...")
+    t = time.time()
+    
+    functions = None
+    if function_cache is not None:
+        functions = function_cache.load('story1', function_shared)
+    
+    if functions is None:
+        functions = OrderedDict()
+        
+        gradient_init        =   T.grad(gsn_cost_init, gsn_params)              
+        gradient_buffer_init =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in gsn_params] 
+        m_gradient_init      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer_init, gradient_init)]
+        param_updates_init   =   [(param, param - learning_rate * mg) for (param, mg) in zip(gsn_params, m_gradient_init)]
+        gradient_buffer_updates_init = zip(gradient_buffer_init, m_gradient_init)
+        updates_init         =   OrderedDict(param_updates_init + gradient_buffer_updates_init)
+        
+        
+        functions['gsn_f_learn_init'] = theano.function(inputs  = [X], 
+                                                        updates = updates_init, 
+                                                        outputs = [show_gsn_cost_init, gsn_init_error])
+        
+        functions['gsn_f_cost_init']  = theano.function(inputs  = [X], 
+                                                        outputs = [show_gsn_cost_init, gsn_init_error])
+        
+        
+        gradient        =   T.grad(gsn_cost, gsn_params)
+        gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in gsn_params]
+        m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+        param_updates   =   [(param, param - learning_rate * mg) for (param, mg) in zip(gsn_params, m_gradient)]
+        gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+            
+        updates         =   OrderedDict(param_updates + gradient_buffer_updates)
+            
+        
+        functions['gsn_f_cost']  = theano.function(inputs  = Xs, 
+                                                   outputs = [show_gsn_cost, gsn_error])
+    
+    
+        functions['gsn_f_learn'] = theano.function(inputs  = Xs, 
+                                                   updates = updates, 
+                                                   outputs = [show_gsn_cost, gsn_error])
+          
+        
+        regression_gradient        =   T.grad(regression_cost, regression_params)
+        regression_gradient_buffer =   [theano.shared(numpy.zeros(rparam.get_value().shape, dtype='float32')) for rparam in regression_params]
+        regression_m_gradient      =   [momentum * rgb + (cast32(1) - momentum) * rg for (rgb, rg) in zip(regression_gradient_buffer, regression_gradient)]
+        regression_param_updates   =   [(rparam, rparam - regression_learning_rate * rmg) for (rparam, rmg) in zip(regression_params, regression_m_gradient)]
+        regression_gradient_buffer_updates = zip(regression_gradient_buffer, regression_m_gradient)
+            
+        regression_updates         =   OrderedDict(regression_param_updates + regression_gradient_buffer_updates)
+        
+        functions['regression_f_cost']  = theano.function(inputs = Xs, 
+                                                          outputs = [show_regression_cost, regression_error])
+            
+        functions['regression_f_learn'] = theano.function(inputs  = Xs, 
+                                                          updates = regression_updates, 
+                                                          outputs = [show_regression_cost, regression_error])
+        
+        functions['f_recon']      = theano.function(inputs = Xs_recon, outputs = [predicted_X_chain_R[-1], p_X_chain_R[-1]])
+        functions['f_recon_init'] = theano.function(inputs=[X], outputs = p_X_chain_R_init[-1])
+        
+        functions['f_noise'] = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
+        
+        if layers == 1: 
+            functions['f_sample_simple'] = theano.function(inputs = [X], outputs = visible_pX_chain[-1])
+        
+        
+        # WHY IS THERE A WARNING????
+        # because the first odd layers are not used -> directly computed FROM THE EVEN layers
+        # unused input = warn
+        functions['f_sample2'] = theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+        
+        if function_cache is not None:
+            function_cache.save('story1', functions, function_shared)
+    
+    logger.log("functions done. took "+make_time_units_string(time.time() - t)+".\n")
     
-    # WHY IS THERE A WARNING????
-    # because the first odd layers are not used -> directly computed FROM THE EVEN layers
-    # unused input = warn
-    f_sample2   =   theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+    gsn_f_learn_init   = functions['gsn_f_learn_init']
+    gsn_f_cost_init    = functions['gsn_f_cost_init']
+    gsn_f_cost         = functions['gsn_f_cost']
+    gsn_f_learn        = functions['gsn_f_learn']
+    regression_f_cost  = functions['regression_f_cost']
+    regression_f_learn = functions['regression_f_learn']
+    f_recon            = functions['f_recon']
+    f_recon_init       = functions['f_recon_init']
+    f_noise            = functions['f_noise']
+    f_sample_simple    = functions.get('f_sample_simple')
+    f_sample2          = functions['f_sample2']
 
     def sample_some_numbers_single_layer():
         x0    =   test_X.get_value()[7:8]
@@ -10,6 +10,7 @@ from utils.image_tiler import tile_raster_images
 from utils import data_tools as data
 from utils.utils import *
 from utils.logger import Logger
+from utils.function_cache import FunctionCache, source_digest
 
 
 def experiment(state, outdir_base='./'):
@@ -418,96 +419,18 @@ def experiment(state, outdir_base='./'):
     gsn_cost      = numpy.sum(gsn_costs)
             
 
-    ###################################
-    # GRADIENTS AND FUNCTIONS FOR GSN #
-    ###################################
-    logger.log(["params:",params])
-    
-    logger.log("creating functions...")
-    start_functions_time = time.time()
-    
-    gradient_gsn        = T.grad(gsn_cost, gsn_params)      
-    gradient_buffer_gsn = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in gsn_params]
-    
-    m_gradient_gsn    = [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer_gsn, gradient_gsn)]
-    param_updates_gsn = [(param, param - learning_rate * mg) for (param, mg) in zip(gsn_params, m_gradient_gsn)]
-    gradient_buffer_updates_gsn = zip(gradient_buffer_gsn, m_gradient_gsn)
-        
-    grad_updates_gsn = OrderedDict(param_updates_gsn + gradient_buffer_updates_gsn)
-    
-    f_cost_gsn = theano.function(inputs  = [X], 
-                                 outputs = gsn_show_cost, 
-                                 on_unused_input='warn')
-
-    f_learn_gsn = theano.function(inputs  = [X],
-                                  updates = grad_updates_gsn,
-                                  outputs = gsn_show_cost,
-                                  on_unused_input='warn')
-    
-    #######################################
-    # GRADIENTS AND FUNCTIONS FOR RNN-GSN #
-    #######################################
-    # if we are not using Hessian-free training create the normal sgd functions
-    if state.hf == 0:
-        gradient      = T.grad(cost, params)      
-        gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
-        
-        m_gradient    = [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-        param_updates = [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient)]
-        gradient_buffer_updates = zip(gradient_buffer, m_gradient)
-            
-        updates = OrderedDict(param_updates + gradient_buffer_updates)
-        updates_train.update(updates)
-    
-        f_learn = theano.function(inputs  = [Xs],
-                                  updates = updates_train,
-                                  outputs = show_cost,
-                                  on_unused_input='warn')
-        
-                
-        f_cost  = theano.function(inputs  = [Xs], 
-                                  updates = updates_cost,
-                                  outputs = show_cost, 
-                                  on_unused_input='warn')
-    
-    logger.log("Training/cost functions done.")
-    compilation_time = time.time() - start_functions_time
-    # Show the compile time with appropriate easy-to-read units.
-    if compilation_time < 60:
-        logger.log(["Compilation took",compilation_time,"seconds.\n\n"])
-    elif compilation_time < 3600:
-        logger.log(["Compilation took",compilation_time/60,"minutes.\n\n"])
-    else:
-        logger.log(["Compilation took",compilation_time/3600,"hours.\n\n"])
-    
     ############################################################################################
     # Denoise some numbers : show number, noisy number, predicted number, reconstructed number #
     ############################################################################################   
     # Recompile the graph without noise for reconstruction function
     # The layer update scheme
     logger.log("Creating graph for noisy reconstruction function at checkpoints during training.")
-    f_recon_init = theano.function(inputs=[X], outputs=x_sample_R_init, on_unused_input='warn')
-    f_recon = theano.function(inputs=[Xs], outputs=x_sample_R, updates=updates_gsn_R)
-    
     # Now do the same but for the GSN in the initial run
     p_X_chain_R = build_gsn_graph(X, noiseflag=False)
-    f_recon_gsn = theano.function(inputs=[X], outputs = p_X_chain_R[-1])
-
-    logger.log("Done compiling all functions.")
-    compilation_time = time.time() - start_functions_time
-    # Show the compile time with appropriate easy-to-read units.
-    if compilation_time < 60:
-        logger.log(["Total time took",compilation_time,"seconds.\n\n"])
-    elif compilation_time < 3600:
-        logger.log(["Total time took",compilation_time/60,"minutes.\n\n"])
-    else:
-        logger.log(["Total time took",compilation_time/3600,"hours.\n\n"])
 
     ############
     # Sampling #
     ############
-    # a function to add salt and pepper noise
-    f_noise = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
     # the input to the sampling function
     X_sample = T.fmatrix("X_sampling")
     network_state_input     =   [X_sample] + [T.fmatrix("H_sampling_"+str(i+1)) for i in range(layers)]
@@ -523,14 +446,139 @@ def experiment(state, outdir_base='./'):
     logger.log("Performing one walkback in network state sampling.")
     update_layers(network_state_output, visible_pX_chain, noisy=True)
 
-    if layers == 1: 
-        f_sample_simple = theano.function(inputs = [X_sample], outputs = visible_pX_chain[-1])
+
+    ###################################
+    # GRADIENTS AND FUNCTIONS FOR GSN #
+    ###################################
+    logger.log(["params:",params])
+    
+    # reuse the compiled functions of an earlier run with the same graph
+    function_cache = None
+    if getattr(state, 'cache_functions', True):
+        function_cache = FunctionCache(config={'model':                  'Story2_rnngsn',
+                                               'N_input':                N_input,
+                                               'layers':                 layers,
+                                               'walkbacks':              walkbacks,
+                                               'hidden_size':            state.hidden_size,
+                                               'recurrent_hidden_size':  state.recurrent_hidden_size,
+                                               'hidden_act':             state.hidden_act,
+                                               'visible_act':            state.visible_act,
+                                               'recurrent_hidden_act':   state.recurrent_hidden_act,
+                                               'cost_funct':             state.cost_funct,
+                                               'hidden_add_noise_sigma': state.hidden_add_noise_sigma,
+                                               'input_salt_and_pepper':  state.input_salt_and_pepper,
+                                               'noiseless_h1':           bool(state.noiseless_h1),
+                                               'input_sampling':         bool(state.input_sampling),
+                                               'hf':                     state.hf,
+                                               'source':                 source_digest(experiment, salt_and_pepper)},
+                                       logger=logger)
+    function_shared = params + [learning_rate, momentum]
+    
+    logger.log("creating functions...")
+    start_functions_time = time.time()
+    
+    functions = None
+    if function_cache is not None:
+        functions = function_cache.load('story2_rnngsn', function_shared)
     
+    if functions is None:
+        functions = OrderedDict()
+        
+        gradient_gsn        = T.grad(gsn_cost, gsn_params)      
+        gradient_buffer_gsn = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in gsn_params]
+        
+        m_gradient_gsn    = [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer_gsn, gradient_gsn)]
+        param_updates_gsn = [(param, param - learning_rate * mg) for (param, mg) in zip(gsn_params, m_gradient_gsn)]
+        gradient_buffer_updates_gsn = zip(gradient_buffer_gsn, m_gradient_gsn)
+            
+        grad_updates_gsn = OrderedDict(param_updates_gsn + gradient_buffer_updates_gsn)
+        
+        functions['f_cost_gsn'] = theano.function(inputs  = [X], 
+                                                  outputs = gsn_show_cost, 
+                                                  on_unused_input='warn')
+    
+        functions['f_learn_gsn'] = theano.function(inputs  = [X],
+                                                   updates = grad_updates_gsn,
+                                                   outputs = gsn_show_cost,
+                                                   on_unused_input='warn')
+        
+        #######################################
+        # GRADIENTS AND FUNCTIONS FOR RNN-GSN #
+        #######################################
+        # if we are not using Hessian-free training create the normal sgd functions
+        if state.hf == 0:
+            gradient      = T.grad(cost, params)      
+            gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
+            
+            m_gradient    = [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+            param_updates = [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient)]
+            gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+                
+            updates = OrderedDict(param_updates + gradient_buffer_updates)
+            updates_train.update(updates)
+        
+            functions['f_learn'] = theano.function(inputs  = [Xs],
+                                                   updates = updates_train,
+                                                   outputs = show_cost,
+                                                   on_unused_input='warn')
+            
+                    
+            functions['f_cost']  = theano.function(inputs  = [Xs], 
+                                                   updates = updates_cost,
+                                                   outputs = show_cost, 
+                                                   on_unused_input='warn')
+        
+        logger.log("Training/cost functions done.")
+        compilation_time = time.time() - start_functions_time
+        # Show the compile time with appropriate easy-to-read units.
+        if compilation_time < 60:
+            logger.log(["Compilation took",compilation_time,"seconds.\n\n"])
+        elif compilation_time < 3600:
+            logger.log(["Compilation took",compilation_time/60,"minutes.\n\n"])
+        else:
+            logger.log(["Compilation took",compilation_time/3600,"hours.\n\n"])
+        
+        logger.log("Creating the noisy reconstruction and sampling functions.")
+        functions['f_recon_init'] = theano.function(inputs=[X], outputs=x_sample_R_init, on_unused_input='warn')
+        functions['f_recon'] = theano.function(inputs=[Xs], outputs=x_sample_R, updates=updates_gsn_R)
+        functions['f_recon_gsn'] = theano.function(inputs=[X], outputs = p_X_chain_R[-1])
+        
+        # a function to add salt and pepper noise
+        functions['f_noise'] = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
+        
+        if layers == 1: 
+            functions['f_sample_simple'] = theano.function(inputs = [X_sample], outputs = visible_pX_chain[-1])
+        
+        
+        # WHY IS THERE A WARNING????
+        # because the first odd layers are not used -> directly computed FROM THE EVEN layers
+        # unused input = warn
+        functions['f_sample2'] = theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+        
+        if function_cache is not None:
+            function_cache.save('story2_rnngsn', functions, function_shared)
+
+
+    logger.log("Done compiling all functions.")
+    compilation_time = time.time() - start_functions_time
+    # Show the compile time with appropriate easy-to-read units.
+    if compilation_time < 60:
+        logger.log(["Total time took",compilation_time,"seconds.\n\n"])
+    elif compilation_time < 3600:
+        logger.log(["Total time took",compilation_time/60,"minutes.\n\n"])
+    else:
+        logger.log(["Total time took",compilation_time/3600,"hours.\n\n"])
     
-    # WHY IS THERE A WARNING????
-    # because the first odd layers are not used -> directly computed FROM THE EVEN layers
-    # unused input = warn
-    f_sample2   =   theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+    f_cost_gsn      = functions['f_cost_gsn']
+    f_learn_gsn     = functions['f_learn_gsn']
+    f_learn         = functions.get('f_learn')
+    f_cost          = functions.get('f_cost')
+    f_recon_init    = functions['f_recon_init']
+    f_recon         = functions['f_recon']
+    f_recon_gsn     = functions['f_recon_gsn']
+    f_noise         = functions['f_noise']
+    f_sample_simple = functions.get('f_sample_simple')
+    f_sample2       = functions['f_sample2']
 
     def sample_some_numbers_single_layer():
         x0    =   test_X.get_value()[:1]
@@ -9,6 +9,7 @@ from utils.image_tiler import tile_raster_images
 import time
 from utils import data_tools as data
 from utils.utils import *
+from utils.function_cache import FunctionCache, source_digest
 from numpy import dtype
 import warnings
 
@@ -290,39 +291,11 @@ def experiment(state, outdir_base='./'):
     params      =   weights_list + recurrent_weights_list + bias_list
     print "params:",params
     
-    print "creating functions..."    
-    gradient        =   T.grad(COST, params)
-                
-    gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
-    
-    m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-    param_updates   =   [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient)]
-    gradient_buffer_updates = zip(gradient_buffer, m_gradient)
-        
-    updates         =   OrderedDict(param_updates + gradient_buffer_updates)
-    
-    
-    #odd layer h's not used from input -> calculated directly from even layers (starting with h_0) since the odd layers are updated first.
-    f_cost          =   theano.function(inputs  = hiddens_input + Xs, 
-                                        outputs = hiddens_output + show_COSTs, 
-                                        on_unused_input='warn')
-
-    f_learn         =   theano.function(inputs  = hiddens_input + Xs,
-                                        updates = updates,
-                                        outputs = hiddens_output + show_COSTs,
-                                        on_unused_input='warn')
-    
-    
-    print "functions done."
-    print
-    
     #############
     # Denoise some numbers  :   show number, noisy number, reconstructed number
     #############
     import random as R
     R.seed(1)
-    # a function to add salt and pepper noise
-    f_noise = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
 
     # Recompile the graph without noise for reconstruction function - the input x_recon is already going to be noisy, and this is to test on a simulated 'real' input.
     X_recon = T.fvector("X_recon")
@@ -342,10 +315,6 @@ def experiment(state, outdir_base='./'):
 #     if state.batch_size <= len(Xs_recon):
 #         for i in range(len(hiddens_R_output)):
 #             hiddens_R_output[i] = H_chain_R[state.batch_size - 1][i]
- 
-    f_recon = theano.function(inputs = hiddens_R_input+Xs_recon, 
-                              outputs = hiddens_R_output+[p_X_chain_R[0] ,p_X_chain_R[-1]], 
-                              on_unused_input="warn") 
 
 
     ############
@@ -367,14 +336,85 @@ def experiment(state, outdir_base='./'):
     print "Performing one walkback in network state sampling."
     _ = update_layers(network_state_output, visible_pX_chain, [X_sample], 0, noisy=True)
 
-    if layers == 1: 
-        f_sample_simple = theano.function(inputs = [X_sample], outputs = visible_pX_chain[-1])
+
+    #############
+    # FUNCTIONS #
+    #############
+    # reuse the compiled functions of an earlier run with the same graph
+    function_cache = None
+    if getattr(state, 'cache_functions', True):
+        function_cache = FunctionCache(config={'model':                  'Story2e_untied_walkbacks',
+                                               'N_input':                N_input,
+                                               'layers':                 layers,
+                                               'walkbacks':              walkbacks,
+                                               'hidden_size':            state.hidden_size,
+                                               'batch_size':             state.batch_size,
+                                               'hidden_act':             state.hidden_act,
+                                               'visible_act':            state.visible_act,
+                                               'cost_funct':             state.cost_funct,
+                                               'hidden_add_noise_sigma': state.hidden_add_noise_sigma,
+                                               'input_salt_and_pepper':  state.input_salt_and_pepper,
+                                               'noiseless_h1':           bool(state.noiseless_h1),
+                                               'input_sampling':         bool(state.input_sampling),
+                                               'source':                 source_digest(experiment, salt_and_pepper)})
+    function_shared = params + [learning_rate, momentum]
     
+    print "creating functions..."    
+    functions = None
+    if function_cache is not None:
+        functions = function_cache.load('story2e', function_shared)
+    
+    if functions is None:
+        functions = OrderedDict()
+        gradient        =   T.grad(COST, params)
+                    
+        gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
+        
+        m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+        param_updates   =   [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient)]
+        gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+            
+        updates         =   OrderedDict(param_updates + gradient_buffer_updates)
+        
+        
+        #odd layer h's not used from input -> calculated directly from even layers (starting with h_0) since the odd layers are updated first.
+        functions['f_cost']  = theano.function(inputs  = hiddens_input + Xs, 
+                                               outputs = hiddens_output + show_COSTs, 
+                                               on_unused_input='warn')
+    
+        functions['f_learn'] = theano.function(inputs  = hiddens_input + Xs,
+                                               updates = updates,
+                                               outputs = hiddens_output + show_COSTs,
+                                               on_unused_input='warn')
+        
+        # a function to add salt and pepper noise
+        functions['f_noise'] = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
+        
+        functions['f_recon'] = theano.function(inputs = hiddens_R_input+Xs_recon, 
+                                               outputs = hiddens_R_output+[p_X_chain_R[0] ,p_X_chain_R[-1]], 
+                                               on_unused_input="warn") 
+        
+        if layers == 1: 
+            functions['f_sample_simple'] = theano.function(inputs = [X_sample], outputs = visible_pX_chain[-1])
+        
+        
+        # WHY IS THERE A WARNING????
+        # because the first odd layers are not used -> directly computed FROM THE EVEN layers
+        # unused input = warn
+        functions['f_sample2'] = theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+        
+        if function_cache is not None:
+            function_cache.save('story2e', functions, function_shared)
+    
+    print "functions done."
+    print
     
-    # WHY IS THERE A WARNING????
-    # because the first odd layers are not used -> directly computed FROM THE EVEN layers
-    # unused input = warn
-    f_sample2   =   theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+    f_cost          = functions['f_cost']
+    f_learn         = functions['f_learn']
+    f_noise         = functions['f_noise']
+    f_recon         = functions['f_recon']
+    f_sample_simple = functions.get('f_sample_simple')
+    f_sample2       = functions['f_sample2']
 
     def sample_some_numbers_single_layer():
         x0    =   test_X.get_value()[:1]
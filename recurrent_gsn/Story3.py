@@ -9,6 +9,7 @@ import time
 from utils import data_tools as data
 import numpy.random as rng
 from utils.utils import *
+from utils.function_cache import FunctionCache, source_digest
 
 
 def experiment(state, outdir_base='./'):
@@ -416,62 +417,6 @@ def experiment(state, outdir_base='./'):
     
      
     
-    print "creating functions..."
-    gradient_init        =   T.grad(COST_pre, params)
-                 
-    gradient_buffer_init =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
-     
-    m_gradient_init      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer_init, gradient_init)]
-    param_updates_init   =   [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient_init)]
-    gradient_buffer_updates_init = zip(gradient_buffer_init, m_gradient_init)
-         
-    updates_init         =   OrderedDict(param_updates_init + gradient_buffer_updates_init)
-    
-    
-    gradient        =   T.grad(COST, params)
-                
-    gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
-    
-    m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-    param_updates   =   [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient)]
-    gradient_buffer_updates = zip(gradient_buffer, m_gradient)
-        
-    updates         =   OrderedDict(param_updates + gradient_buffer_updates)
-    
-    
-    f_cost          =   theano.function(inputs  = recurrent_hiddens_input + [X, X1], 
-                                        outputs = recurrent_hiddens_output + [show_COST_pre, show_COST_post], 
-                                        on_unused_input='warn')
-
-    f_learn         =   theano.function(inputs  = recurrent_hiddens_input + [X, X1], 
-                                        updates = updates, 
-                                        outputs = recurrent_hiddens_output + [show_COST_pre, show_COST_post],
-                                        on_unused_input='warn')
-    
-    f_learn_init    =   theano.function(inputs  = [X], 
-                                        updates = updates_init, 
-                                        outputs = [show_COST_pre],
-                                        on_unused_input='warn')
-       
-    
-    
-    recurrent_gradient        =   T.grad(COST_post, recurrent_params)
-    recurrent_gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in recurrent_params]
-    recurrent_m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(recurrent_gradient_buffer, recurrent_gradient)]
-    recurrent_param_updates   =   [(param, param - recurrent_learning_rate * mg) for (param, mg) in zip(recurrent_params, recurrent_m_gradient)]
-    recurrent_gradient_buffer_updates = zip(recurrent_gradient_buffer, recurrent_m_gradient)
-        
-    recurrent_updates         =   OrderedDict(recurrent_param_updates + recurrent_gradient_buffer_updates)
-    
-
-    recurrent_f_learn         =   theano.function(inputs  = recurrent_hiddens_input + [X,X1],
-                                                  updates = recurrent_updates,
-                                                  outputs = recurrent_hiddens_output + [show_COST_post],
-                                                  on_unused_input='warn')
-
-    print "functions done."
-    print
-    
     #############
     # Denoise some numbers  :   show number, noisy number, reconstructed number
     #############
@@ -480,10 +425,6 @@ def experiment(state, outdir_base='./'):
     # Grab 100 random indices from test_X
     random_idx      =   numpy.array(R.sample(range(len(test_X.get_value())), 100))
     numbers         =   test_X.get_value()[random_idx]
-    
-    f_noise         =   theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
-    noisy_numbers   =   f_noise(test_X.get_value()[random_idx])
-    #noisy_numbers   =   salt_and_pepper(numbers, state.input_salt_and_pepper)
 
     # Recompile the graph without noise for reconstruction function
     X_recon          = T.fvector("X_recon")
@@ -496,11 +437,7 @@ def experiment(state, outdir_base='./'):
 
     # The layer update scheme
     print "Creating graph for noisy reconstruction function at checkpoints during training."
-    hiddens_R, recurrent_hiddens_output, p_X_chain_R, p_H_chain_R, p_X1_chain_R = build_graph(hiddens_R, hiddens_R_output, noiseflag=False)
-
-    f_recon = theano.function(inputs = hiddens_R_input+[X_recon], 
-                              outputs = hiddens_R_output+[p_X_chain_R[-1] ,p_X1_chain_R[-1]], 
-                              on_unused_input="warn")
+    hiddens_R, recurrent_hiddens_R_output, p_X_chain_R, p_H_chain_R, p_X1_chain_R = build_graph(hiddens_R, hiddens_R_output, noiseflag=False)
 
 
     ############
@@ -522,14 +459,120 @@ def experiment(state, outdir_base='./'):
     print "Performing one walkback in network state sampling."
     update_layers(network_state_output, visible_pX_chain, noisy=True)
 
-    if layers == 1: 
-        f_sample_simple = theano.function(inputs = [X], outputs = visible_pX_chain[-1])
+
+    #############
+    # FUNCTIONS #
+    #############
+    # reuse the compiled functions of an earlier run with the same graph
+    function_cache = None
+    if getattr(state, 'cache_functions', True):
+        function_cache = FunctionCache(config={'model':                  'Story3',
+                                               'N_input':                N_input,
+                                               'layers':                 layers,
+                                               'walkbacks':              walkbacks,
+                                               'recurrent_layers':       recurrent_layers,
+                                               'recurrent_walkbacks':    recurrent_walkbacks,
+                                               'hidden_size':            state.hidden_size,
+                                               'recurrent_hidden_size':  state.recurrent_hidden_size,
+                                               'act':                    state.act,
+                                               'hidden_add_noise_sigma': state.hidden_add_noise_sigma,
+                                               'input_salt_and_pepper':  state.input_salt_and_pepper,
+                                               'noiseless_h1':           bool(state.noiseless_h1),
+                                               'input_sampling':         bool(state.input_sampling),
+                                               'source':                 source_digest(experiment, salt_and_pepper)})
+    function_shared = params + recurrent_params + [learning_rate, recurrent_learning_rate, momentum]
+    
+    print "creating functions..."
+    functions = None
+    if function_cache is not None:
+        functions = function_cache.load('story3', function_shared)
+    
+    if functions is None:
+        functions = OrderedDict()
+        gradient_init        =   T.grad(COST_pre, params)
+                     
+        gradient_buffer_init =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
+         
+        m_gradient_init      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer_init, gradient_init)]
+        param_updates_init   =   [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient_init)]
+        gradient_buffer_updates_init = zip(gradient_buffer_init, m_gradient_init)
+             
+        updates_init         =   OrderedDict(param_updates_init + gradient_buffer_updates_init)
+        
+        
+        gradient        =   T.grad(COST, params)
+                    
+        gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in params]
+        
+        m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+        param_updates   =   [(param, param - learning_rate * mg) for (param, mg) in zip(params, m_gradient)]
+        gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+            
+        updates         =   OrderedDict(param_updates + gradient_buffer_updates)
+        
+        
+        functions['f_cost']       = theano.function(inputs  = recurrent_hiddens_input + [X, X1], 
+                                                    outputs = recurrent_hiddens_output + [show_COST_pre, show_COST_post], 
+                                                    on_unused_input='warn')
+    
+        functions['f_learn']      = theano.function(inputs  = recurrent_hiddens_input + [X, X1], 
+                                                    updates = updates, 
+                                                    outputs = recurrent_hiddens_output + [show_COST_pre, show_COST_post],
+                                                    on_unused_input='warn')
+        
+        functions['f_learn_init'] = theano.function(inputs  = [X], 
+                                                    updates = updates_init, 
+                                                    outputs = [show_COST_pre],
+                                                    on_unused_input='warn')
+           
+        
+        
+        recurrent_gradient        =   T.grad(COST_post, recurrent_params)
+        recurrent_gradient_buffer =   [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in recurrent_params]
+        recurrent_m_gradient      =   [momentum * gb + (cast32(1) - momentum) * g for (gb, g) in zip(recurrent_gradient_buffer, recurrent_gradient)]
+        recurrent_param_updates   =   [(param, param - recurrent_learning_rate * mg) for (param, mg) in zip(recurrent_params, recurrent_m_gradient)]
+        recurrent_gradient_buffer_updates = zip(recurrent_gradient_buffer, recurrent_m_gradient)
+            
+        recurrent_updates         =   OrderedDict(recurrent_param_updates + recurrent_gradient_buffer_updates)
+        
+    
+        functions['recurrent_f_learn'] = theano.function(inputs  = recurrent_hiddens_input + [X,X1],
+                                                         updates = recurrent_updates,
+                                                         outputs = recurrent_hiddens_output + [show_COST_post],
+                                                         on_unused_input='warn')
+        
+        functions['f_noise'] = theano.function(inputs = [X], outputs = salt_and_pepper(X, state.input_salt_and_pepper))
+        
+        functions['f_recon'] = theano.function(inputs = hiddens_R_input+[X_recon], 
+                                               outputs = hiddens_R_output+[p_X_chain_R[-1] ,p_X1_chain_R[-1]], 
+                                               on_unused_input="warn")
+        
+        if layers == 1: 
+            functions['f_sample_simple'] = theano.function(inputs = [X], outputs = visible_pX_chain[-1])
+        
+        
+        # WHY IS THERE A WARNING????
+        # because the first odd layers are not used -> directly computed FROM THE EVEN layers
+        # unused input = warn
+        functions['f_sample2'] = theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+        
+        if function_cache is not None:
+            function_cache.save('story3', functions, function_shared)
+
+    print "functions done."
+    print
     
+    f_cost            = functions['f_cost']
+    f_learn           = functions['f_learn']
+    f_learn_init      = functions['f_learn_init']
+    recurrent_f_learn = functions['recurrent_f_learn']
+    f_noise           = functions['f_noise']
+    f_recon           = functions['f_recon']
+    f_sample_simple   = functions.get('f_sample_simple')
+    f_sample2         = functions['f_sample2']
     
-    # WHY IS THERE A WARNING????
-    # because the first odd layers are not used -> directly computed FROM THE EVEN layers
-    # unused input = warn
-    f_sample2   =   theano.function(inputs = network_state_input, outputs = network_state_output + visible_pX_chain, on_unused_input='warn')
+    noisy_numbers   =   f_noise(test_X.get_value()[random_idx])
+    #noisy_numbers   =   salt_and_pepper(numbers, state.input_salt_and_pepper)
 
     def sample_some_numbers_single_layer():
         x0    =   test_X.get_value()[:1]
@@ -0,0 +1,271 @@
+'''
+.. module: numpy_gsn
+
+This module gives a pure NumPy execution backend for sampling from a trained Generative Stochastic Network.
+
+The symbolic helpers in generative_stochastic_network.GSN have to be compiled with theano.function before
+a single sample can be drawn. This class runs the same odd/even walkback schedule (with the same salt-and-pepper,
+gaussian and binomial noise) directly on the trained weights_list/bias_list values, so a sampling job can start
+producing chains immediately. All of the layer updates are batched matrix-matrix products, so they run through
+whatever BLAS numpy is linked against.
+'''
+__authors__ = "Markus Beissinger"
+__copyright__ = "Copyright 2015, Vitruvian Science"
+__credits__ = ["Markus Beissinger", "Li Yao"]
+__license__ = "Apache"
+__maintainer__ = "OpenDeep"
+__email__ = "dev@opendeep.org"
+
+# standard libraries
+import cPickle
+import time
+# third-party libraries
+import numpy
+# internal references
+import utils.logger as log
+from utils.utils import make_time_units_string
+
+# Default values to use for the sampling parameters. These match the defaults in generative_stochastic_network.
+_defaults = {"visible_activation": 'sigmoid',
+             "hidden_activation": 'tanh',
+             "input_sampling": True,
+             "add_noise": True,
+             "noiseless_h1": True,
+             "hidden_add_noise_sigma": 2,
+             "input_salt_and_pepper": 0.4,
+             "dtype": 'float32'}
+
+
+def _sigmoid(x):
+    # in-place logistic sigmoid: 1 / (1 + exp(-x))
+    numpy.negative(x, out=x)
+    numpy.exp(x, out=x)
+    x += 1
+    numpy.reciprocal(x, out=x)
+    return x
+
+def _tanh(x):
+    return numpy.tanh(x, out=x)
+
+def _rectifier(x):
+    return numpy.maximum(x, 0, out=x)
+
+def get_numpy_activation_function(name):
+    '''
+    NumPy counterpart of utils.utils.get_activation_function. The returned functions work in-place on their input.
+    '''
+    if name == 'sigmoid':
+        return _sigmoid
+    elif name == 'rectifier':
+        return _rectifier
+    elif name == 'tanh':
+        return _tanh
+    else:
+        raise NotImplementedError("Did not recognize activation {0!s}, please use tanh, rectifier, or sigmoid".format(name))
+
+def _to_array(param, dtype):
+    # accept theano shared variables as well as plain arrays
+    if hasattr(param, 'get_value'):
+        param = param.get_value(borrow=True)
+    return numpy.ascontiguousarray(param, dtype=dtype)
+
+
+class NumpyGSN(object):
+    '''
+    Runs the GSN transition operator with numpy instead of a compiled theano graph.
+    '''
+    def __init__(self,
+                 weights_list,
+                 bias_list,
+                 visible_activation     = _defaults["visible_activation"],
+                 hidden_activation      = _defaults["hidden_activation"],
+                 input_sampling         = _defaults["input_sampling"],
+                 add_noise              = _defaults["add_noise"],
+                 noiseless_h1           = _defaults["noiseless_h1"],
+                 hidden_add_noise_sigma = _defaults["hidden_add_noise_sigma"],
+                 input_salt_and_pepper  = _defaults["input_salt_and_pepper"],
+                 rng                    = None,
+                 dtype                  = _defaults["dtype"],
+                 logger                 = None):
+        """
+        @type  weights_list: List(matrix)
+        @param weights_list: The trained weights between layers (numpy arrays or theano shared variables).
+
+        @type  bias_list: List(vector)
+        @param bias_list: The trained biases for each layer (numpy arrays or theano shared variables).
+
+        @type  visible_activation: String or Function
+        @param visible_activation: 'sigmoid', 'tanh', 'rectifier', or a numpy function for the visible layer.
+
+        @type  hidden_activation: String or Function
+        @param hidden_activation: 'sigmoid', 'tanh', 'rectifier', or a numpy function for the hidden layers.
+
+        @type  rng: numpy.random.RandomState
+        @param rng: Random generator for all of the noise. Defaults to RandomState(1).
+        """
+        if len(bias_list) != len(weights_list) + 1:
+            raise ValueError("Expected {0!s} biases for {1!s} weight matrices, got {2!s}".format(len(weights_list)+1, len(weights_list), len(bias_list)))
+        self.dtype        = dtype
+        self.weights_list = [_to_array(w, dtype) for w in weights_list]
+        self.bias_list    = [_to_array(b, dtype) for b in bias_list]
+        self.layers       = len(self.weights_list)
+
+        if isinstance(visible_activation, basestring):
+            visible_activation = get_numpy_activation_function(visible_activation)
+        if isinstance(hidden_activation, basestring):
+            hidden_activation = get_numpy_activation_function(hidden_activation)
+        self.visible_activation = visible_activation
+        self.hidden_activation  = hidden_activation
+
+        self.input_sampling         = input_sampling
+        self.add_noise              = add_noise
+        self.noiseless_h1           = noiseless_h1
+        self.hidden_add_noise_sigma = hidden_add_noise_sigma
+        self.input_salt_and_pepper  = input_salt_and_pepper
+
+        if rng is None:
+            rng = numpy.random.RandomState(1)
+        self.rng    = rng
+        self.logger = logger
+
+    @classmethod
+    def load(cls, filename, layers, **kwargs):
+        '''
+        Creates the sampler from a parameter pickle saved by GSN/RNN_GSN.save_params
+        (the weights_list followed by the bias_list).
+        '''
+        with open(filename, 'rb') as f:
+            params = cPickle.load(f)
+        return cls(params[:layers], params[layers:2*layers+1], **kwargs)
+
+    ##################
+    # NOISE FUNCTIONS #
+    ##################
+    def salt_and_pepper(self, IN, p):
+        a = self.rng.random_sample(IN.shape) < (1 - p)
+        b = self.rng.random_sample(IN.shape) < 0.5
+        c = numpy.logical_and(numpy.logical_not(a), b)
+        return (IN * a + c).astype(self.dtype)
+
+    def add_gaussian_noise(self, IN, std):
+        IN += (std * self.rng.standard_normal(IN.shape)).astype(self.dtype)
+        return IN
+
+    def binomial(self, p):
+        return (self.rng.random_sample(p.shape) < p).astype(self.dtype)
+
+    ################################
+    # LAYER UPDATES (ODD THEN EVEN) #
+    ################################
+    def update_layers(self, hiddens, p_X_chain, add_noise=None):
+        # One update over the odd layers + one update over the even layers
+        self.update_odd_layers(hiddens, add_noise)
+        self.update_even_layers(hiddens, p_X_chain, add_noise)
+
+    def update_layers_reverse(self, hiddens, p_X_chain, add_noise=None):
+        # One update over the even layers + one update over the odd layers
+        self.update_even_layers(hiddens, p_X_chain, add_noise)
+        self.update_odd_layers(hiddens, add_noise)
+
+    def update_odd_layers(self, hiddens, add_noise=None):
+        for i in range(1, len(hiddens), 2):
+            self.simple_update_layer(hiddens, None, i, add_noise)
+
+    def update_even_layers(self, hiddens, p_X_chain, add_noise=None):
+        for i in range(0, len(hiddens), 2):
+            self.simple_update_layer(hiddens, p_X_chain, i, add_noise)
+
+    def simple_update_layer(self, hiddens, p_X_chain, i, add_noise=None):
+        '''
+        Same computation as GSN.simple_update_layer, modifying the hiddens list in-place.
+        '''
+        if add_noise is None:
+            add_noise = self.add_noise
+        # Compute the dot product, whatever layer
+        if i == 0:
+            h = numpy.dot(hiddens[i+1], self.weights_list[i].T)
+        elif i == len(hiddens)-1:
+            h = numpy.dot(hiddens[i-1], self.weights_list[i-1])
+        else:
+            h = numpy.dot(hiddens[i+1], self.weights_list[i].T)
+            h += numpy.dot(hiddens[i-1], self.weights_list[i-1])
+        h += self.bias_list[i]
+
+        # Add pre-activation noise if NOT input layer
+        if i == 1 and self.noiseless_h1:
+            add_noise = False
+
+        # pre activation noise
+        if i != 0 and add_noise:
+            h = self.add_gaussian_noise(h, self.hidden_add_noise_sigma)
+
+        # ACTIVATION!
+        if i == 0:
+            h = self.visible_activation(h)
+        else:
+            h = self.hidden_activation(h)
+
+        # post activation noise
+        if i != 0 and add_noise:
+            h = self.add_gaussian_noise(h, self.hidden_add_noise_sigma)
+
+        # build the reconstruction chain if updating the visible layer X
+        if i == 0:
+            p_X_chain.append(h)
+            if self.input_sampling:
+                sampled = self.binomial(h)
+            else:
+                sampled = h
+            # salt and pepper is always applied to the input, like the theano graph
+            hiddens[i] = self.salt_and_pepper(sampled, self.input_salt_and_pepper)
+        else:
+            hiddens[i] = h
+
+    ##############
+    #  SAMPLING  #
+    ##############
+    def init_hiddens(self, X, add_noise=None):
+        '''
+        The starting network state [X, h1, h2, ...] for a batch of visible inputs X (one chain per row).
+        '''
+        if add_noise is None:
+            add_noise = self.add_noise
+        X = numpy.asarray(X, dtype=self.dtype)
+        if add_noise:
+            X = self.salt_and_pepper(X, self.input_salt_and_pepper)
+        return [X] + [numpy.zeros((X.shape[0], w.shape[1]), dtype=self.dtype) for w in self.weights_list]
+
+    def pxh(self, h1):
+        '''
+        The visible expectation p(X|h1) for a batch of first hidden layer values (one row per sample).
+        '''
+        x = numpy.dot(numpy.asarray(h1, dtype=self.dtype), self.weights_list[0].T)
+        x += self.bias_list[0]
+        return self.visible_activation(x)
+
+    def sample(self, initial, n_samples=400, k=1):
+        '''
+        Runs a chain from every row of initial for n_samples-1 walkbacks, like GSN.sample.
+
+        @rtype:   Tuple
+        @return:  (the stacked visible chain starting with initial, the list of hidden tuples (h1, h2, ...) taken every k steps)
+        '''
+        log.maybeLog(self.logger, "Starting numpy sampling...")
+        initial = numpy.asarray(initial, dtype=self.dtype)
+        network_state = self.init_hiddens(initial, add_noise=True)
+
+        visible_chain = [initial]
+        sampled_h = []
+        times = []
+        for i in xrange(n_samples-1):
+            _t = time.time()
+            self.update_layers(network_state, visible_chain)
+            if i % k == 0:
+                # one copy per layer, the layers can have different widths
+                sampled_h.append(tuple(numpy.array(h) for h in network_state[1:]))
+                if i == k:
+                    log.maybeLog(self.logger, "About "+make_time_units_string(numpy.mean(times)*(n_samples-1-i))+" remaining...")
+            times.append(time.time() - _t)
+
+        log.maybeLog(self.logger, "Sampling done.")
+        return numpy.vstack(visible_chain), sampled_h
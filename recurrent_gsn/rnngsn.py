@@ -23,9 +23,11 @@ import theano.sandbox.rng_mrg as RNG_MRG
 
 from utils import data_tools as data
 from generative_stochastic_network import GSN
+from numpy_gsn import NumpyGSN
 import utils.logger as log
 from utils.image_tiler import tile_raster_images
-from utils.utils import cast32, logit, trunc, get_shared_weights, get_shared_bias, salt_and_pepper, make_time_units_string, get_activation_function, get_cost_function, raise_to_list, closest_to_square_factors, copy_params, restore_params
+from utils.function_cache import FunctionCache, describe_callable, source_digest
+from utils.utils import cast32, logit, trunc, get_shared_weights, get_shared_bias, salt_and_pepper, make_time_units_string, get_activation_function, get_cost_function, raise_to_list, closest_to_square_factors, copy_params, restore_params, run_in_background
 
 # Default values to use for some RNN-GSN parameters
 defaults = {# gsn parameters
@@ -49,6 +51,9 @@ defaults = {# gsn parameters
             "early_stop_threshold": .9995,
             "early_stop_length": 30,
             "hessian_free": False,
+            "sequence_batch_size": 1, # >1 trains on that many padded, masked sequence windows at once
+            "bucket_sequences": True, # batch the sequence windows by length (shuffled within a length) to cut padding
+            "stateful": False, # truncated BPTT: each window starts from the final recurrent state of the previous window of its sequence
             "learning_rate": 0.25,
             "annealing": 0.995,
             "momentum": 0.5,
@@ -61,8 +66,12 @@ defaults = {# gsn parameters
             "noise_annealing": 1.0, #no noise schedule by default
             # data parameters
             "is_image": True,
+            "checkpoint_images": False, # write the reconstruction and (in the background) the sample images at checkpoints
             "vis_init": False,
-            "output_path": '../outputs/rnn_gsn/'}
+            "output_path": '../outputs/rnn_gsn/',
+            # compilation parameters
+            "cache_functions": True, # whether to reuse compiled functions from an earlier run with the same architecture
+            "function_cache_dir": None} # None uses a directory inside theano's compiledir
 
 
 class RNN_GSN():
@@ -98,13 +107,14 @@ class RNN_GSN():
             if args.get("input_size") is None:
                 raise AssertionError("Please either specify input_size in the arguments or provide an example train_X for input dimensionality.")
         else:
-            self.N_input = self.train_X[0].get_value(borrow=True).shape[1]
+            self.N_input = data.dataset_shape(self.train_X[0])[1]
         
         self.is_image = args.get('is_image', defaults['is_image'])
         if self.is_image:
             (_h, _w) = closest_to_square_factors(self.N_input)
             self.image_width  = args.get('width', _w)
             self.image_height = args.get('height', _h)
+        self.checkpoint_images = args.get('checkpoint_images', defaults['checkpoint_images'])
             
         #######################################
         # Network and training specifications #
@@ -118,6 +128,9 @@ class RNN_GSN():
         self.noise_annealing = cast32(args.get('noise_annealing', defaults['noise_annealing'])) # exponential noise annealing coefficient
         self.batch_size      = args.get('batch_size', defaults['batch_size'])
         self.gsn_batch_size = args.get('gsn_batch_size', defaults['gsn_batch_size'])
+        self.sequence_batch_size = args.get('sequence_batch_size', defaults['sequence_batch_size'])
+        self.bucket_sequences = args.get('bucket_sequences', defaults['bucket_sequences'])
+        self.stateful        = args.get('stateful', defaults['stateful'])
         self.n_epoch         = args.get('n_epoch', defaults['n_epoch'])
         self.early_stop_threshold = args.get('early_stop_threshold', defaults['early_stop_threshold'])
         self.early_stop_length = args.get('early_stop_length', defaults['early_stop_length'])
@@ -137,18 +150,30 @@ class RNN_GSN():
         
         self.f_recon = None
         self.f_noise = None
+        self.f_generate = None # compiled the first time generate() is called
+        self.f_step = None # compiled the first time a streaming session is created
+        self.sample_worker = None # background thread rendering the checkpoint samples
+        self.sample_worker_epoch = None
+        self.sample_logger = None # logs to outdir/sampling/log.txt, made by the first background sampler
+        self.f_learn_batch = None # padded multi-sequence functions, compiled the first time they are needed
+        self.f_cost_batch = None
+        self.f_learn_state = None # the same taking and returning the recurrent state, for stateful training
+        self.f_cost_state = None
         
         # Activation functions!
         # For the GSN:
         if args.get('hidden_activation') is not None:
             log.maybeLog(self.logger, 'Using specified activation for GSN hiddens')
             self.hidden_activation = args.get('hidden_activation')
+            self.hidden_act = None # no numpy counterpart for the background sampler
         elif args.get('hidden_act') is not None:
             self.hidden_activation = get_activation_function(args.get('hidden_act'))
+            self.hidden_act = args.get('hidden_act')
             log.maybeLog(self.logger, 'Using {0!s} activation for GSN hiddens'.format(args.get('hidden_act')))
         else:
             log.maybeLog(self.logger, "Using default activation for GSN hiddens")
             self.hidden_activation = defaults['hidden_activation']
+            self.hidden_act = 'tanh'
             
         # For the RNN:
         if args.get('recurrent_hidden_activation') is not None:
@@ -165,12 +190,15 @@ class RNN_GSN():
         if args.get('visible_activation') is not None:
             log.maybeLog(self.logger, 'Using specified activation for visible layer')
             self.visible_activation = args.get('visible_activation')
+            self.visible_act = None
         elif args.get('visible_act') is not None:
             self.visible_activation = get_activation_function(args.get('visible_act'))
+            self.visible_act = args.get('visible_act')
             log.maybeLog(self.logger, 'Using {0!s} activation for visible layer'.format(args.get('visible_act')))
         else:
             log.maybeLog(self.logger, 'Using default activation for visible layer')
             self.visible_activation = defaults['visible_activation']
+            self.visible_act = 'sigmoid'
             
         # Cost function!
         if args.get('cost_function') is not None:
@@ -348,64 +376,190 @@ class RNN_GSN():
         #############
         log.maybeLog(self.logger, '\nCost w.r.t p(X|...) at every step in the graph')
         start_functions_time = time.time()
-
-        # if we are not using Hessian-free training create the normal sgd functions
-        if not self.hessian_free:
-            gradient      = T.grad(cost, self.params)      
-            gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
-            
-            m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-            param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
-            gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+        
+        # shared variables the compiled functions depend on - cached functions get rebound to these
+        self.function_shared = self.params + [self.learning_rate, self.momentum, self.hidden_add_noise_sigma, self.input_salt_and_pepper]
+        self.function_cache = None
+        if args.get('cache_functions', defaults['cache_functions']):
+            self.function_cache = FunctionCache(config=self.architecture_config(),
+                                                cache_dir=args.get('function_cache_dir', defaults['function_cache_dir']),
+                                                logger=self.logger)
+        
+        functions = None
+        if self.function_cache is not None:
+            functions = self.function_cache.load('rnngsn', self.function_shared)
+            
+        if functions is None:
+            functions = OrderedDict()
+            # if we are not using Hessian-free training create the normal sgd functions
+            if not self.hessian_free:
+                updates_train.update(self.sgd_updates(cost))
+            
+                log.maybeLog(self.logger, "rnn-gsn learn...")
+                functions['f_learn'] = theano.function(inputs  = [self.Xs],
+                                                       updates = updates_train,
+                                                       outputs = [show_cost, error],
+                                                       on_unused_input='warn',
+                                                       name='rnngsn_f_learn')
                 
-            updates = OrderedDict(param_updates + gradient_buffer_updates)
-            updates_train.update(updates)
-        
-            log.maybeLog(self.logger, "rnn-gsn learn...")
-            self.f_learn = theano.function(inputs  = [self.Xs],
-                                      updates = updates_train,
-                                      outputs = [show_cost, error],
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_learn')
-            
-            log.maybeLog(self.logger, "rnn-gsn cost...")
-            self.f_cost  = theano.function(inputs  = [self.Xs],
-                                      updates = updates_cost,
-                                      outputs = [show_cost, error],
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_cost')
-        
-        log.maybeLog(self.logger, "Training/cost functions done.")
-        
-        # Denoise some numbers : show number, noisy number, predicted number, reconstructed number
-        log.maybeLog(self.logger, "Creating graph for noisy reconstruction function at checkpoints during training.")
-        self.f_recon = theano.function(inputs=[self.Xs],
-                                       outputs=[x_sample_recon[-1], recon_show_cost],
-                                       name='rnngsn_f_recon')
-        
-        # a function to add salt and pepper noise
-        self.f_noise = theano.function(inputs = [self.X],
-                                       outputs = salt_and_pepper(self.X, self.input_salt_and_pepper),
-                                       name='rnngsn_f_noise')
-        # Sampling functions
-        log.maybeLog(self.logger, "Creating sampling function...")
-        if self.layers == 1: 
-            self.f_sample = theano.function(inputs = [X_sample],
-                                            outputs = visible_pX_chain[-1],
-                                            name='rnngsn_f_sample_single_layer')
-        else:
-            self.f_sample = theano.function(inputs = self.network_state_input,
-                                            outputs = self.network_state_output + visible_pX_chain,
-                                            on_unused_input='warn',
-                                            name='rnngsn_f_sample')
+                log.maybeLog(self.logger, "rnn-gsn cost...")
+                functions['f_cost']  = theano.function(inputs  = [self.Xs],
+                                                       updates = updates_cost,
+                                                       outputs = [show_cost, error],
+                                                       on_unused_input='warn',
+                                                       name='rnngsn_f_cost')
+            
+            log.maybeLog(self.logger, "Training/cost functions done.")
+            
+            # Denoise some numbers : show number, noisy number, predicted number, reconstructed number
+            log.maybeLog(self.logger, "Creating graph for noisy reconstruction function at checkpoints during training.")
+            functions['f_recon'] = theano.function(inputs=[self.Xs],
+                                                   outputs=[x_sample_recon[-1], recon_show_cost],
+                                                   name='rnngsn_f_recon')
+            
+            # a function to add salt and pepper noise
+            functions['f_noise'] = theano.function(inputs = [self.X],
+                                                   outputs = salt_and_pepper(self.X, self.input_salt_and_pepper),
+                                                   name='rnngsn_f_noise')
+            # Sampling functions
+            log.maybeLog(self.logger, "Creating sampling function...")
+            if self.layers == 1: 
+                functions['f_sample'] = theano.function(inputs = [X_sample],
+                                                        outputs = visible_pX_chain[-1],
+                                                        name='rnngsn_f_sample_single_layer')
+            else:
+                functions['f_sample'] = theano.function(inputs = self.network_state_input,
+                                                        outputs = self.network_state_output + visible_pX_chain,
+                                                        on_unused_input='warn',
+                                                        name='rnngsn_f_sample')
+            
+            if self.function_cache is not None:
+                self.function_cache.save('rnngsn', functions, self.function_shared)
+            log.maybeLog(self.logger, "Done compiling all functions.")
         
-    
-        log.maybeLog(self.logger, "Done compiling all functions.")
+        for name, function in functions.items():
+            setattr(self, name, function)
         compilation_time = time.time() - start_functions_time
         # Show the compile time with appropriate easy-to-read units.
         log.maybeLog(self.logger, "Total compilation time took "+make_time_units_string(compilation_time)+".\n\n")
       
         
+    def sgd_updates(self, cost):
+        '''
+        The momentum SGD updates for all of the parameters given a cost.
+        '''
+        gradient      = T.grad(cost, self.params)      
+        gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
+        
+        m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+        param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
+        gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+            
+        return OrderedDict(param_updates + gradient_buffer_updates)
+        
+    def compile_batch_functions(self, stateful=False):
+        '''
+        Compiles f_learn_batch and f_cost_batch, which train on many sequences at once: a (time, batch, features)
+        tensor of sequences padded to a common length, and a (time, batch) mask that is 1 on the real frames.
+        The recurrence runs over all sequences together (matrix-matrix products), and holds u on the padding.
+        Only the real frames are gathered into the GSN, so the costs are the same as for one long sequence of them.
+        
+        With stateful, compiles f_learn_state and f_cost_state instead. They also take the (batch, recurrent_hidden_size)
+        initial recurrent state, and return the final one after the cost and error. The gradients stop at the initial
+        state, so feeding each window the state from the previous window of its sequence is truncated BPTT.
+        '''
+        cache_name = 'rnngsn_state' if stateful else 'rnngsn_batch'
+        functions = None
+        if self.function_cache is not None:
+            functions = self.function_cache.load(cache_name, self.function_shared)
+        if functions is None:
+            log.maybeLog(self.logger, "Compiling the padded multi-sequence training functions...")
+            t = time.time()
+            Xs = T.ftensor3('Xs_batch')
+            mask = T.fmatrix('Xs_mask')
+            
+            def batch_recurrent_step(x_t, m_t, u_tm1, *_):
+                # hiddens for this frame from the previous recurrent state, like recurrent_step
+                h_t = T.concatenate([self.hidden_activation(self.bias_list[i+1] + T.dot(u_tm1, self.recurrent_to_gsn_weights_list[(i+1)/2])) for i in range(self.layers) if i%2 == 0], axis=1)
+                u_t = self.recurrent_hidden_activation(T.dot(x_t, self.W_x_u) + T.dot(u_tm1, self.W_u_u) + self.recurrent_bias)
+                # keep the old state where the sequence is already over
+                m = m_t.dimshuffle(0, 'x')
+                u_t = m * u_t + (cast32(1) - m) * u_tm1
+                return [u_t, h_t]
+            
+            u0 = T.fmatrix('u0_batch')
+            (u, h_t), updates_recurrent = theano.scan(fn=batch_recurrent_step,
+                                                      sequences=[Xs, mask],
+                                                      outputs_info=[u0, None],
+                                                      non_sequences=self.params)
+            
+            # gather the real frames, (time*batch, ...) rows
+            valid = T.flatten(mask).nonzero()[0]
+            X_valid = Xs.reshape((Xs.shape[0]*Xs.shape[1], Xs.shape[2]))[valid]
+            h_valid = h_t.reshape((h_t.shape[0]*h_t.shape[1], h_t.shape[2]))[valid]
+            h_list = [T.zeros_like(X_valid)]
+            for layer, w in enumerate(self.weights_list):
+                if layer%2 != 0:
+                    h_list.append(T.zeros_like(T.dot(h_list[-1], w)))
+                else:
+                    h_list.append(h_valid[:, (layer/2)*self.hidden_size:(layer/2+1)*self.hidden_size])
+            
+            _, _, cost, show_cost, error = GSN.build_gsn_given_hiddens(X_valid, h_list, self.weights_list, self.bias_list, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation, self.walkbacks, self.cost_function)
+            
+            updates_learn = OrderedDict(updates_recurrent)
+            updates_learn.update(self.sgd_updates(cost))
+            functions = OrderedDict()
+            if stateful:
+                functions['f_learn_state'] = theano.function(inputs  = [Xs, mask, u0],
+                                                             updates = updates_learn,
+                                                             outputs = [show_cost, error, u[-1]],
+                                                             on_unused_input='warn',
+                                                             name='rnngsn_f_learn_state')
+                functions['f_cost_state']  = theano.function(inputs  = [Xs, mask, u0],
+                                                             updates = updates_recurrent,
+                                                             outputs = [show_cost, error, u[-1]],
+                                                             on_unused_input='warn',
+                                                             name='rnngsn_f_cost_state')
+            else:
+                # every sequence starts from zeros
+                zeros = {u0: T.zeros((Xs.shape[1], self.recurrent_hidden_size), dtype='float32')}
+                functions['f_learn_batch'] = theano.function(inputs  = [Xs, mask],
+                                                             updates = updates_learn,
+                                                             outputs = [show_cost, error],
+                                                             givens  = zeros,
+                                                             on_unused_input='warn',
+                                                             name='rnngsn_f_learn_batch')
+                functions['f_cost_batch']  = theano.function(inputs  = [Xs, mask],
+                                                             updates = updates_recurrent,
+                                                             outputs = [show_cost, error],
+                                                             givens  = zeros,
+                                                             on_unused_input='warn',
+                                                             name='rnngsn_f_cost_batch')
+            if self.function_cache is not None:
+                self.function_cache.save(cache_name, functions, self.function_shared)
+            log.maybeLog(self.logger, "Multi-sequence functions took "+make_time_units_string(time.time() - t)+" to compile.")
+        for name, function in functions.items():
+            setattr(self, name, function)
+        
+    def architecture_config(self):
+        '''
+        Everything that changes the compiled theano graphs - used as the key for the compiled function cache.
+        '''
+        return {'model':                       self.__class__.__name__,
+                'input_size':                  self.N_input,
+                'layers':                      self.layers,
+                'walkbacks':                   self.walkbacks,
+                'hidden_size':                 self.hidden_size,
+                'recurrent_hidden_size':       self.recurrent_hidden_size,
+                'hidden_activation':           describe_callable(self.hidden_activation),
+                'visible_activation':          describe_callable(self.visible_activation),
+                'recurrent_hidden_activation': describe_callable(self.recurrent_hidden_activation),
+                'cost_function':               describe_callable(self.cost_function),
+                'noiseless_h1':                bool(self.noiseless_h1),
+                'input_sampling':              bool(self.input_sampling),
+                'hessian_free':                bool(self.hessian_free),
+                # the code building the graphs: this module, the GSN updates and the noise functions
+                'source':                      source_digest(RNN_GSN, GSN, salt_and_pepper)}
         
     def train(self, train_X=None, train_Y=None, valid_X=None, valid_Y=None, test_X=None, test_Y=None, is_artificial=False, artificial_sequence=1, continue_training=False):
         log.maybeLog(self.logger, "\nTraining---------\n")
@@ -470,14 +624,30 @@ class RNN_GSN():
             best_params = None
             patience = 0
                         
-            log.maybeLog(self.logger, ['train X size:',str(train_X[0].get_value(borrow=True).shape)])
+            log.maybeLog(self.logger, ['train X size:',str(data.dataset_shape(train_X[0]))])
             if valid_X is not None:
-                log.maybeLog(self.logger, ['valid X size:',str(valid_X[0].get_value(borrow=True).shape)])
+                log.maybeLog(self.logger, ['valid X size:',str(data.dataset_shape(valid_X[0]))])
             if test_X is not None:
-                log.maybeLog(self.logger, ['test X size:',str(test_X[0].get_value(borrow=True).shape)])
+                log.maybeLog(self.logger, ['test X size:',str(data.dataset_shape(test_X[0]))])
+            
+            # train on many padded sequence windows at a time instead of one window of one song,
+            # stateful training always goes through the padded functions (with one sequence per batch if need be)
+            batched = self.sequence_batch_size > 1 or self.stateful
+            if self.stateful and self.f_learn_state is None:
+                self.compile_batch_functions(stateful=True)
+            elif batched and self.f_learn_batch is None:
+                self.compile_batch_functions()
+            
+            def sequence_costs(X, learn, shuffle=False):
+                # yields (cost, error, frames, padded_size, seconds) for each padded batch
+                if self.stateful:
+                    return data.iterate_stateful_cost_function(self.f_learn_state if learn else self.f_cost_state, X, self.batch_size, self.sequence_batch_size,
+                                                               self.recurrent_hidden_size, bucket=self.bucket_sequences, shuffle=shuffle)
+                return data.iterate_sequence_cost_function(self.f_learn_batch if learn else self.f_cost_batch, X, self.batch_size, self.sequence_batch_size,
+                                                           bucket=self.bucket_sequences, shuffle=shuffle)
             
             if self.vis_init:
-                self.bias_list[0].set_value(logit(numpy.clip(0.9,0.001,train_X[0].get_value(borrow=True).mean(axis=0))))
+                self.bias_list[0].set_value(logit(numpy.clip(0.9,0.001,data.dataset_slice(train_X[0], 0, data.dataset_length(train_X[0])).mean(axis=0))))
                 
             start_time = time.time()
         
@@ -492,19 +662,34 @@ class RNN_GSN():
                 #train
                 train_costs = []
                 train_errors = []
-                for train_data in train_X:
-                    costs_and_errors = data.apply_cost_function_to_dataset(self.f_learn, train_data, self.batch_size)
-                    train_costs.extend([cost for (cost, error) in costs_and_errors])
-                    train_errors.extend([error for (cost, error) in costs_and_errors])
+                if batched:
+                    frames, padded_size, train_time = 0, 0, 0.
+                    for cost, error, n, size, seconds in sequence_costs(train_X, True, shuffle=self.bucket_sequences):
+                        train_costs.append(cost)
+                        train_errors.append(error)
+                        frames += n
+                        padded_size += size
+                        train_time += seconds
+                else:
+                    for train_data in train_X:
+                        costs_and_errors = data.apply_cost_function_to_dataset(self.f_learn, train_data, self.batch_size)
+                        train_costs.extend([cost for (cost, error) in costs_and_errors])
+                        train_errors.extend([error for (cost, error) in costs_and_errors])
                 log.maybeAppend(self.logger, ['Train:',trunc(numpy.mean(train_costs)),trunc(numpy.mean(train_errors)),'\t'])
+                if batched and padded_size > 0 and train_time > 0:
+                    # fraction of the padded batches that is padding, and real frames trained per second
+                    log.maybeAppend(self.logger, ['Padding:',trunc(1 - float(frames)/padded_size),'Frames/s:',trunc(frames/train_time),'\t'])
          
          
                 #valid
                 if valid_X is not None:
                     valid_costs = []
-                    for valid_data in valid_X:
-                        cs = data.apply_cost_function_to_dataset(self.f_cost, valid_data, self.batch_size)
-                        valid_costs.extend([c for c,e in cs])
+                    if batched:
+                        valid_costs.extend([c for c,e,_,_,_ in sequence_costs(valid_X, False)])
+                    else:
+                        for valid_data in valid_X:
+                            cs = data.apply_cost_function_to_dataset(self.f_cost, valid_data, self.batch_size)
+                            valid_costs.extend([c for c,e in cs])
                     log.maybeAppend(self.logger, ['Valid:',trunc(numpy.mean(valid_costs)), '\t'])
          
          
@@ -512,10 +697,15 @@ class RNN_GSN():
                 if test_X is not None:
                     test_costs = []
                     test_errors = []
-                    for test_data in test_X:
-                        costs_and_errors = data.apply_cost_function_to_dataset(self.f_cost, test_data, self.batch_size)
-                        test_costs.extend([cost for (cost, error) in costs_and_errors])
-                        test_errors.extend([error for (cost, error) in costs_and_errors])
+                    if batched:
+                        for cost, error, _, _, _ in sequence_costs(test_X, False):
+                            test_costs.append(cost)
+                            test_errors.append(error)
+                    else:
+                        for test_data in test_X:
+                            costs_and_errors = data.apply_cost_function_to_dataset(self.f_cost, test_data, self.batch_size)
+                            test_costs.extend([cost for (cost, error) in costs_and_errors])
+                            test_errors.extend([error for (cost, error) in costs_and_errors])
                     log.maybeAppend(self.logger, ['Test:',trunc(numpy.mean(test_costs)),trunc(numpy.mean(test_errors)), '\t'])
                 
                  
@@ -547,23 +737,26 @@ class RNN_GSN():
         
                 if (counter % self.save_frequency) == 0 or STOP is True:
                     n_examples = 100
-                    xs_test = test_X[0].get_value(borrow=True)[range(n_examples)]
-                    noisy_xs_test = self.f_noise(test_X[0].get_value(borrow=True)[range(n_examples)])
-                    reconstructions = []
-                    for i in xrange(0, len(noisy_xs_test)):
-                        recon, recon_cost = self.f_recon(noisy_xs_test[max(0,(i+1)-self.batch_size):i+1])
-                        reconstructions.append(recon)
+                    xs_test = data.dataset_slice(test_X[0], 0, n_examples)
+                    noisy_xs_test = self.f_noise(xs_test)
+                    # each frame is reconstructed from the window of (up to) batch_size frames ending at it;
+                    # every frame inside the first window comes out of one call over that window
+                    first = min(self.batch_size, len(noisy_xs_test))
+                    recon, recon_cost = self.f_recon(noisy_xs_test[:first])
+                    reconstructions = list(recon)
+                    for i in xrange(first, len(noisy_xs_test)):
+                        recon, recon_cost = self.f_recon(noisy_xs_test[(i+1)-self.batch_size:i+1])
+                        reconstructions.append(recon[-1])
                     reconstructed = numpy.array(reconstructions)
-                    if (self.is_image):
+                    if self.is_image and self.checkpoint_images:
                         # Concatenate stuff
-                        # stacked = numpy.vstack([numpy.vstack([xs_test[i*10 : (i+1)*10], noisy_xs_test[i*10 : (i+1)*10], reconstructed[i*10 : (i+1)*10]]) for i in range(10)])
-                        # number_reconstruction = PIL.Image.fromarray(tile_raster_images(stacked, (self.image_height, self.image_width), (10,30)))
+                        stacked = numpy.vstack([numpy.vstack([xs_test[i*10 : (i+1)*10], noisy_xs_test[i*10 : (i+1)*10], reconstructed[i*10 : (i+1)*10]]) for i in range(10)])
+                        number_reconstruction = PIL.Image.fromarray(tile_raster_images(stacked, (self.image_height, self.image_width), (10,30)))
                             
-                        # number_reconstruction.save(self.outdir+'rnngsn_reconstruction_epoch_'+str(counter)+'.png')
+                        number_reconstruction.save(self.outdir+'rnngsn_reconstruction_epoch_'+str(counter)+'.png')
             
-                        #sample_numbers(counter, 'seven')
-#                         plot_samples(counter, 'rnngsn')
-                        pass
+                        # sampling runs on a background thread from a snapshot of the parameters, training goes on meanwhile
+                        self.plot_samples_in_background(counter, 'rnngsn', test_X=test_X, wait=STOP)
             
                     #save params
                     self.save_params('all', counter, self.params)
@@ -575,6 +768,7 @@ class RNN_GSN():
                 new_noise = self.input_salt_and_pepper.get_value() * self.noise_annealing
                 self.input_salt_and_pepper.set_value(new_noise)
                 
+            self.join_sample_worker()
             log.maybeLog(self.logger, "\n------------TOTAL RNN-GSN TRAIN TIME TOOK {0!s}---------".format(make_time_units_string(time.time()-start_time)))
     
 
@@ -588,7 +782,7 @@ class RNN_GSN():
     def gen_10k_samples(self):
         for i,x in enumerate(self.test_X):
             log.maybeLog(self.logger, 'Generating 10,000 samples {0!s}/{1!s}'.format(i,len(self.test_X)))
-            samples, _ = self.sample(x.get_value()[1:2], 1000, 1)
+            samples, _ = self.sample(data.dataset_slice(x, 1, 2), 1000, 1)
             f_samples = 'samples_test{0!s}.npy'.format(i)
             numpy.save(f_samples, samples)
             log.maybeLog(self.logger, 'saved digits')
@@ -656,14 +850,144 @@ class RNN_GSN():
         else:
             return sample_some_numbers(n_samples)
         
-    def plot_samples(self, epoch_number="", leading_text="", n_samples=400):
-        to_sample = time.time()
-        initial = self.test_X.get_value(borrow=True)[:1]
-        rand_idx = numpy.random.choice(range(self.test_X.get_value(borrow=True).shape[0]))
-        rand_init = self.test_X.get_value(borrow=True)[rand_idx:rand_idx+1]
+    def hiddens_from_recurrent(self, x_like, u_tm1):
+        '''
+        The starting GSN hiddens [x, h1, h2, ...] given the recurrent state u_tm1 (one row per sequence).
+        The odd layers come from the recurrent weights and the rest start at zero, like the training graph.
+        '''
+        hiddens = [T.zeros_like(x_like)]
+        for layer, w in enumerate(self.weights_list):
+            if layer%2 != 0:
+                hiddens.append(T.zeros_like(T.dot(hiddens[-1], w)))
+            else:
+                hiddens.append(self.hidden_activation(self.bias_list[layer+1] + T.dot(u_tm1, self.recurrent_to_gsn_weights_list[layer/2])))
+        return hiddens
+    
+    def compile_generate_function(self):
+        '''
+        Compiles the whole n-step generation chain (GSN walkbacks, input sampling and the recurrent u_t update)
+        into a single theano.scan, so generating a sequence is one call instead of several per step.
+        '''
+        functions = None
+        if self.function_cache is not None:
+            functions = self.function_cache.load('rnngsn_generate', self.function_shared)
+        if functions is None:
+            log.maybeLog(self.logger, "Compiling the scan generation function...")
+            t = time.time()
+            x0 = T.fmatrix('x0_generate') # last visible frame, one row per chain
+            u0 = T.fmatrix('u0_generate') # recurrent state before x0, one row per chain
+            n_steps = T.iscalar('n_steps')
+            
+            def generate_step(x_tm1, u_tm2, *_):
+                # recurrent update with the last generated frame
+                u_tm1 = self.recurrent_hidden_activation(T.dot(x_tm1, self.W_x_u) + T.dot(u_tm2, self.W_u_u) + self.recurrent_bias)
+                # run the GSN conditioned on the recurrent state
+                hiddens = self.hiddens_from_recurrent(x_tm1, u_tm1)
+                p_X_chain = []
+                for _ in range(self.walkbacks):
+                    GSN.update_layers_reverse(hiddens, self.weights_list, self.bias_list, p_X_chain, True, self.noiseless_h1, self.hidden_add_noise_sigma, self.input_salt_and_pepper, self.input_sampling, self.MRG, self.visible_activation, self.hidden_activation)
+                x_mean = p_X_chain[-1]
+                if self.input_sampling:
+                    x_t = self.MRG.binomial(p=x_mean, size=x_mean.shape, dtype='float32')
+                else:
+                    x_t = x_mean
+                return [x_mean, x_t, u_tm1]
+            
+            (x_means, x_ts, us), updates_generate = theano.scan(fn=generate_step,
+                                                                outputs_info=[None, x0, u0],
+                                                                non_sequences=self.params,
+                                                                n_steps=n_steps)
+            functions = {'f_generate': theano.function(inputs=[x0, u0, n_steps],
+                                                       outputs=[x_means, x_ts[-1], us[-1]],
+                                                       updates=updates_generate,
+                                                       name='rnngsn_f_generate')}
+            if self.function_cache is not None:
+                self.function_cache.save('rnngsn_generate', functions, self.function_shared)
+            log.maybeLog(self.logger, "Generation function took "+make_time_units_string(time.time() - t)+" to compile.")
+        self.f_generate = functions['f_generate']
+    
+    def generate_chunks(self, initial, n_steps=400, chunk_size=100):
+        '''
+        Generates n_steps frames following the frames in initial (one chain per row), yielding them
+        chunk_size steps at a time as (steps*chains, input_size) arrays in the same step-major order as sample().
+        The recurrent state is carried between chunks so the result is one continuous chain.
+        '''
+        if self.f_generate is None:
+            self.compile_generate_function()
+        x = numpy.asarray(initial, dtype='float32')
+        u = numpy.zeros((x.shape[0], self.recurrent_hidden_size), dtype='float32')
+        remaining = n_steps
+        while remaining > 0:
+            steps = min(chunk_size, remaining)
+            x_means, x, u = self.f_generate(x, u, steps)
+            remaining -= steps
+            yield x_means.reshape((-1, x_means.shape[-1]))
+    
+    def generate(self, initial, n_samples=400):
+        '''
+        Like sample(), but the whole chain runs inside one compiled scan and includes the recurrent state.
+        Returns the visible chain (starting with initial) as one array.
+        '''
+        t = time.time()
+        log.maybeLog(self.logger, "Starting scan generation...")
+        chain = [numpy.asarray(initial, dtype='float32')] + list(self.generate_chunks(initial, n_samples-1, n_samples-1))
+        log.maybeLog(self.logger, "Generation done in "+make_time_units_string(time.time() - t))
+        return numpy.vstack(chain)
+    
+    def compile_step_function(self):
+        '''
+        Compiles f_step(x_t, u_tm1) -> (prediction, u_t) for one frame of any number of streams (one row each).
+        u_t is the recurrent update with the observed frame, and prediction is the GSN mean for the next frame
+        given u_t, found with the same walkbacks as generation but deterministic: no hidden noise, no input
+        sampling and no salt and pepper between walkbacks, so the same (x_t, u_tm1) always gives the same prediction.
+        '''
+        functions = None
+        if self.function_cache is not None:
+            functions = self.function_cache.load('rnngsn_step', self.function_shared)
+        if functions is None:
+            log.maybeLog(self.logger, "Compiling the single step function...")
+            t = time.time()
+            x_t = T.fmatrix('x_step')
+            u_tm1 = T.fmatrix('u_step')
+            u_t = self.recurrent_hidden_activation(T.dot(x_t, self.W_x_u) + T.dot(u_tm1, self.W_u_u) + self.recurrent_bias)
+            hiddens = self.hiddens_from_recurrent(x_t, u_t)
+            p_X_chain = []
+            for _ in range(self.walkbacks):
+                GSN.update_layers_reverse(hiddens, self.weights_list, self.bias_list, p_X_chain, False, self.noiseless_h1, self.hidden_add_noise_sigma, cast32(0), False, self.MRG, self.visible_activation, self.hidden_activation)
+            functions = {'f_step': theano.function(inputs=[x_t, u_tm1],
+                                                   outputs=[p_X_chain[-1], u_t],
+                                                   on_unused_input='ignore',
+                                                   name='rnngsn_f_step')}
+            if self.function_cache is not None:
+                self.function_cache.save('rnngsn_step', functions, self.function_shared)
+            log.maybeLog(self.logger, "Step function took "+make_time_units_string(time.time() - t)+" to compile.")
+        self.f_step = functions['f_step']
+    
+    def session(self, n_streams=1):
+        '''
+        A StreamingSession feeding this model n_streams sequences one frame at a time.
+        '''
+        if self.f_step is None:
+            self.compile_step_function()
+        return StreamingSession(self, n_streams)
         
-        V, _ = self.sample(initial, n_samples)
-        rand_V, _ = self.sample(rand_init, n_samples)
+    def plot_samples(self, epoch_number="", leading_text="", n_samples=400, test_X=None):
+        initial, rand_init = self._sample_initials(test_X)
+        self._save_samples(self.sample, initial, rand_init, epoch_number, leading_text, n_samples, self.logger)
+        
+    def _sample_initials(self, test_X=None):
+        # the first test frame and a random one to start the two sample chains from
+        if test_X is None:
+            test_X = self.test_X
+        initial = data.dataset_slice(test_X[0], 0, 1)
+        rand_idx = numpy.random.choice(data.dataset_length(test_X[0]))
+        rand_init = data.dataset_slice(test_X[0], rand_idx, rand_idx+1)
+        return initial, rand_init
+        
+    def _save_samples(self, sample, initial, rand_init, epoch_number, leading_text, n_samples, logger):
+        to_sample = time.time()
+        V, _ = sample(initial, n_samples)
+        rand_V, _ = sample(rand_init, n_samples)
         
         img_samples = PIL.Image.fromarray(tile_raster_images(V, (self.image_height, self.image_width), closest_to_square_factors(n_samples)))
         rand_img_samples = PIL.Image.fromarray(tile_raster_images(rand_V, (self.image_height, self.image_width), closest_to_square_factors(n_samples)))
@@ -672,7 +996,58 @@ class RNN_GSN():
         img_samples.save(fname)
         rfname = self.outdir+leading_text+'samples_rand_epoch_'+str(epoch_number)+'.png'
         rand_img_samples.save(rfname) 
-        log.maybeLog(self.logger, 'Took ' + make_time_units_string(time.time() - to_sample) + ' to sample '+str(n_samples*2)+' numbers')
+        log.maybeLog(logger, 'Took ' + make_time_units_string(time.time() - to_sample) + ' to sample '+str(n_samples*2)+' numbers')
+        
+    def plot_samples_in_background(self, epoch_number="", leading_text="", n_samples=400, test_X=None, wait=False):
+        '''
+        Runs plot_samples on a background thread with a NumpyGSN built from a copy of the parameters as they are now,
+        so it touches none of the theano shared variables (or the device they live on) while training goes on.
+        At most one sampler runs at a time: while the one from the last checkpoint is still going the new
+        samples are skipped, or with wait it is joined first. With a custom activation that NumpyGSN can't
+        run, the samples are drawn here with the compiled sampler instead.
+        '''
+        if self.sample_worker is not None:
+            if self.sample_worker.is_alive() and not wait:
+                log.maybeLog(self.logger, 'Still sampling from the last checkpoint, skipping the samples for epoch '+str(epoch_number))
+                return
+            # reap the finished (or waited for) worker before starting the next one
+            self.join_sample_worker()
+        if self.visible_act is None or self.hidden_act is None:
+            self.plot_samples(epoch_number, leading_text, n_samples, test_X)
+            return
+        if self.sample_logger is None:
+            # log to outdir/sampling/log.txt only, so nothing gets written into the middle of the epoch lines
+            self.sample_logger = log.Logger(os.path.join(self.outdir, 'sampling'))
+            self.sample_logger.out = open(os.devnull, 'w')
+        logger = self.sample_logger
+        params = [p.get_value() for p in self.params]
+        sampler = NumpyGSN(params[:self.layers],
+                           params[self.layers:2*self.layers+1],
+                           visible_activation     = self.visible_act,
+                           hidden_activation      = self.hidden_act,
+                           input_sampling         = self.input_sampling,
+                           noiseless_h1           = self.noiseless_h1,
+                           hidden_add_noise_sigma = float(self.hidden_add_noise_sigma.get_value()),
+                           input_salt_and_pepper  = float(self.input_salt_and_pepper.get_value()),
+                           rng                    = numpy.random.RandomState(numpy.random.randint(2**31 - 1)),
+                           logger                 = logger)
+        initial, rand_init = self._sample_initials(test_X)
+        self.sample_worker = run_in_background(self._save_samples, sampler.sample, initial, rand_init, epoch_number, leading_text, n_samples, logger)
+        self.sample_worker_epoch = epoch_number
+        
+    def join_sample_worker(self):
+        '''
+        Waits for the background sampler (if any) and logs that its samples are done.
+        '''
+        if self.sample_worker is None:
+            return
+        self.sample_worker.join()
+        if self.sample_worker.error is None:
+            log.maybeLog(self.logger, 'Samples for epoch '+str(self.sample_worker_epoch)+' done.')
+        else:
+            log.maybeLog(self.logger, 'Sampling for epoch '+str(self.sample_worker_epoch)+' failed:\n'+self.sample_worker.error)
+        self.sample_worker = None
+        self.sample_worker_epoch = None
         
     #############################
     # Save the model parameters #
@@ -710,3 +1085,60 @@ class RNN_GSN():
     
     
     
+
+
+
+class StreamingSession():
+    '''
+    Incremental inference with an RNN_GSN: holds the recurrent state u of n_streams sequences, so each new frame
+    costs one call of the compiled single step function however long the sequences already are.
+    Create with RNN_GSN.session().
+    '''
+    def __init__(self, model, n_streams=1):
+        self.model = model
+        self.n_streams = n_streams
+        self.reset()
+        
+    def reset(self):
+        '''
+        Starts all the streams over from the zero recurrent state.
+        '''
+        self.u = numpy.zeros((self.n_streams, self.model.recurrent_hidden_size), dtype='float32')
+        self.prediction = None
+        self.n_frames = 0
+        
+    def step(self, x_t):
+        '''
+        Feeds one frame (one row per stream, or a single vector when there is one stream) and returns the
+        prediction for the next frame, in the same shape.
+        '''
+        x_t = numpy.asarray(x_t, dtype='float32')
+        prediction, self.u = self.model.f_step(x_t.reshape((self.n_streams, -1)), self.u)
+        self.prediction = prediction.reshape(x_t.shape)
+        self.n_frames += 1
+        return self.prediction
+        
+    def feed(self, frames):
+        '''
+        Feeds a (time, input_size) sequence (or (time, n_streams, input_size) for several streams) frame by frame,
+        and returns the prediction for the frame after the last one.
+        '''
+        for x_t in frames:
+            self.step(x_t)
+        return self.prediction
+        
+    def continue_sequence(self, n_steps, sample=False):
+        '''
+        Continues the streams for n_steps frames by feeding back each prediction (a binomial sample of it with sample).
+        Returns the generated frames as a (n_steps, n_streams, input_size) array.
+        '''
+        if self.prediction is None:
+            raise ValueError("Feed the streams at least one frame before continuing them.")
+        frames = []
+        for _ in xrange(n_steps):
+            x = self.prediction.reshape((self.n_streams, -1))
+            if sample:
+                x = rng.binomial(n=1, p=x, size=x.shape).astype('float32')
+            frames.append(x)
+            self.step(x)
+        return numpy.asarray(frames)
@@ -28,6 +28,7 @@ def main():
     parser.add_argument('--n_epoch', type=int, default=500)
     parser.add_argument('--gsn_batch_size', type=int, default=100)
     parser.add_argument('--batch_size', type=int, default=200) # max length of sequence to consider
+    parser.add_argument('--sequence_batch_size', type=int, default=1) # number of padded sequence windows per training batch (1 trains one window at a time)
     parser.add_argument('--save_frequency', type=int, default=10) #number of epochs between parameters being saved
     parser.add_argument('--early_stop_threshold', type=float, default=0.9995) #0.9995
     parser.add_argument('--early_stop_length', type=int, default=30)
@@ -55,15 +56,22 @@ def main():
     parser.add_argument('--input_sampling', type=int, default=1)
     parser.add_argument('--test_model', type=int, default=0)
     parser.add_argument('--continue_training', type=int, default=0) #default=0
+    parser.add_argument('--cache_functions', type=int, default=1) # reuse compiled theano functions from earlier runs with the same architecture
+    parser.add_argument('--bucket_sequences', type=int, default=1) # with sequence_batch_size > 1, batch sequence windows of similar length together
+    parser.add_argument('--stateful', type=int, default=0) # truncated BPTT, carry the recurrent state from one window of a song to the next
+    parser.add_argument('--packed', type=int, default=0) # keep the piano rolls bit-packed and expand only the current minibatch
     
     return parser.parse_args()
     
 def create_rnngsn(args):
-    (train,_), (valid,_), (test,_) = data.load_datasets(args.dataset, args.data_path)
+    (train,_), (valid,_), (test,_) = data.load_datasets(args.dataset, args.data_path, packed=args.packed)
               
-    train_X = [theano.shared(t, borrow=True) for t in train]
-    valid_X = [theano.shared(v, borrow=True) for v in valid]
-    test_X  = [theano.shared(t, borrow=True) for t in test]
+    if args.packed:
+        train_X, valid_X, test_X = train, valid, test
+    else:
+        train_X = [theano.shared(t, borrow=True) for t in train]
+        valid_X = [theano.shared(v, borrow=True) for v in valid]
+        test_X  = [theano.shared(t, borrow=True) for t in test]
     
     args.is_image = True
     
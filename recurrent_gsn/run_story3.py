@@ -36,6 +36,7 @@ def main():
     parser.add_argument('--input_sampling', type=int, default=1)
     parser.add_argument('--test_model', type=int, default=0)
     parser.add_argument('--continue_training', type=int, default=1) #default=0
+    parser.add_argument('--cache_functions', type=int, default=1) # reuse compiled theano functions from earlier runs with the same architecture
     
     args = parser.parse_args()
        
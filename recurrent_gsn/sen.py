@@ -21,6 +21,7 @@ from utils import data_tools as data
 from recurrent_gsn import generative_stochastic_network
 import utils.logger as log
 from utils.image_tiler import tile_raster_images
+from utils.function_cache import FunctionCache, describe_callable, source_digest
 from utils.utils import cast32, logit, trunc, get_shared_weights, get_shared_bias, salt_and_pepper, \
     make_time_units_string
 
@@ -68,7 +69,10 @@ defaults = {# gsn parameters
             # data parameters
             "is_image": True,
             "vis_init": False,
-            "output_path": '../outputs/sen/'}
+            "output_path": '../outputs/sen/',
+            # compilation parameters
+            "cache_functions": True, # whether to reuse compiled functions from an earlier run with the same architecture
+            "function_cache_dir": None} # None uses a directory inside theano's compiledir
 
 
 class SEN():
@@ -409,68 +413,105 @@ class SEN():
         #############
         log.maybeLog(self.logger, '\nCost w.r.t p(X|...) at every step in the graph')
         start_functions_time = time.time()
-
-        # if we are not using Hessian-free training create the normal sgd functions
-        if not self.hessian_free:
-            gradient      = T.grad(cost, self.params)      
-            gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
+        
+        # shared variables the compiled functions depend on - cached functions get rebound to these
+        self.function_shared = self.params + [self.learning_rate, self.momentum, self.hidden_add_noise_sigma, self.input_salt_and_pepper]
+        self.function_cache = None
+        if args.get('cache_functions', defaults['cache_functions']):
+            self.function_cache = FunctionCache(config=self.architecture_config(),
+                                                cache_dir=args.get('function_cache_dir', defaults['function_cache_dir']),
+                                                logger=self.logger)
+        
+        functions = None
+        if self.function_cache is not None:
+            functions = self.function_cache.load('sen', self.function_shared)
             
-            m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
-            param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
-            gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+        if functions is None:
+            functions = OrderedDict()
+            # if we are not using Hessian-free training create the normal sgd functions
+            if not self.hessian_free:
+                gradient      = T.grad(cost, self.params)      
+                gradient_buffer = [theano.shared(numpy.zeros(param.get_value().shape, dtype='float32')) for param in self.params]
                 
-            updates = OrderedDict(param_updates + gradient_buffer_updates)
-            updates_train.update(updates)
-        
-            log.maybeLog(self.logger, "rnn-gsn learn...")
-            self.f_learn = theano.function(inputs  = [self.Xs],
-                                      updates = updates_train,
-                                      outputs = show_cost,
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_learn')
+                m_gradient    = [self.momentum * gb + (cast32(1) - self.momentum) * g for (gb, g) in zip(gradient_buffer, gradient)]
+                param_updates = [(param, param - self.learning_rate * mg) for (param, mg) in zip(self.params, m_gradient)]
+                gradient_buffer_updates = zip(gradient_buffer, m_gradient)
+                    
+                updates = OrderedDict(param_updates + gradient_buffer_updates)
+                updates_train.update(updates)
             
-            log.maybeLog(self.logger, "rnn-gsn cost...")
-            self.f_cost  = theano.function(inputs  = [self.Xs],
-                                      updates = updates_cost,
-                                      outputs = show_cost, 
-                                      on_unused_input='warn',
-                                      name='rnngsn_f_cost')
-        
-        log.maybeLog(self.logger, "Training/cost functions done.")
-        
-        # Denoise some numbers : show number, noisy number, predicted number, reconstructed number
-        log.maybeLog(self.logger, "Creating graph for noisy reconstruction function at checkpoints during training.")
-        self.f_recon = theano.function(inputs=[self.Xs],
-                                       outputs=x_sample_recon[-1],
-                                       updates=updates_recurrent_recon,
-                                       name='rnngsn_f_recon')
-        
-        # a function to add salt and pepper noise
-        self.f_noise = theano.function(inputs = [self.X],
-                                       outputs = salt_and_pepper(self.X, self.input_salt_and_pepper),
-                                       name='rnngsn_f_noise')
-        # Sampling functions
-        log.maybeLog(self.logger, "Creating sampling function...")
-        if self.gsn_layers == 1: 
-            self.f_sample = theano.function(inputs = [X_sample],
-                                            outputs = visible_pX_chain[-1],
-                                            name='rnngsn_f_sample_single_layer')
-        else:
-            # WHY IS THERE A WARNING????
-            # because the first odd layers are not used -> directly computed FROM THE EVEN layers
-            # unused input = warn
-            self.f_sample = theano.function(inputs = self.network_state_input,
-                                            outputs = self.network_state_output + visible_pX_chain,
-                                            on_unused_input='warn',
-                                            name='rnngsn_f_sample')
+                log.maybeLog(self.logger, "rnn-gsn learn...")
+                functions['f_learn'] = theano.function(inputs  = [self.Xs],
+                                                       updates = updates_train,
+                                                       outputs = show_cost,
+                                                       on_unused_input='warn',
+                                                       name='rnngsn_f_learn')
+                
+                log.maybeLog(self.logger, "rnn-gsn cost...")
+                functions['f_cost']  = theano.function(inputs  = [self.Xs],
+                                                       updates = updates_cost,
+                                                       outputs = show_cost, 
+                                                       on_unused_input='warn',
+                                                       name='rnngsn_f_cost')
+            
+            log.maybeLog(self.logger, "Training/cost functions done.")
+            
+            # Denoise some numbers : show number, noisy number, predicted number, reconstructed number
+            log.maybeLog(self.logger, "Creating graph for noisy reconstruction function at checkpoints during training.")
+            functions['f_recon'] = theano.function(inputs=[self.Xs],
+                                                   outputs=x_sample_recon[-1],
+                                                   updates=updates_recurrent_recon,
+                                                   name='rnngsn_f_recon')
+            
+            # a function to add salt and pepper noise
+            functions['f_noise'] = theano.function(inputs = [self.X],
+                                                   outputs = salt_and_pepper(self.X, self.input_salt_and_pepper),
+                                                   name='rnngsn_f_noise')
+            # Sampling functions
+            log.maybeLog(self.logger, "Creating sampling function...")
+            if self.gsn_layers == 1: 
+                functions['f_sample'] = theano.function(inputs = [X_sample],
+                                                        outputs = visible_pX_chain[-1],
+                                                        name='rnngsn_f_sample_single_layer')
+            else:
+                # WHY IS THERE A WARNING????
+                # because the first odd layers are not used -> directly computed FROM THE EVEN layers
+                # unused input = warn
+                functions['f_sample'] = theano.function(inputs = self.network_state_input,
+                                                        outputs = self.network_state_output + visible_pX_chain,
+                                                        on_unused_input='warn',
+                                                        name='rnngsn_f_sample')
+            
+            if self.function_cache is not None:
+                self.function_cache.save('sen', functions, self.function_shared)
+            log.maybeLog(self.logger, "Done compiling all functions.")
          
-    
-        log.maybeLog(self.logger, "Done compiling all functions.")
+        for name, function in functions.items():
+            setattr(self, name, function)
         compilation_time = time.time() - start_functions_time
         # Show the compile time with appropriate easy-to-read units.
         log.maybeLog(self.logger, "Total compilation time took "+make_time_units_string(compilation_time)+".\n\n")
       
         
+    def architecture_config(self):
+        '''
+        Everything that changes the compiled theano graphs - used as the key for the compiled function cache.
+        '''
+        return {'model':                       self.__class__.__name__,
+                'layer_sizes':                 tuple(self.layer_sizes),
+                'top_layer_sizes':             tuple(self.top_layer_sizes),
+                'walkbacks':                   self.walkbacks,
+                'recurrent_hidden_size':       self.recurrent_hidden_size,
+                'hidden_activation':           describe_callable(self.hidden_activation),
+                'visible_activation':          describe_callable(self.visible_activation),
+                'recurrent_hidden_activation': describe_callable(self.recurrent_hidden_activation),
+                'cost_function':               describe_callable(self.cost_function),
+                'noiseless_h1':                bool(self.noiseless_h1),
+                'input_sampling':              bool(self.input_sampling),
+                'hessian_free':                bool(self.hessian_free),
+                # the code building the graphs: this module, the GSN updates and the noise functions
+                'source':                      source_digest(SEN, generative_stochastic_network, salt_and_pepper)}
+        
         
     def train(self, train_X=None, train_Y=None, valid_X=None, valid_Y=None, test_X=None, test_Y=None, is_artificial=False, artificial_sequence=1, continue_training=False):
         log.maybeLog(self.logger, "\nTraining---------\n")
@@ -8,18 +8,198 @@ https://github.com/yaoli/GSN
 import numpy
 import theano
 import theano.tensor as T
-import os, cPickle, gzip, errno, urllib, glob, zipfile
-from utils import cast32
+import os, sys, cPickle, gzip, errno, urllib, glob, zipfile, hashlib, time, threading, Queue
+from utils import cast32, parallel_imap
 import scipy.io as io
 from midi.utils import midiread
 
+def _prefetch_worker(dataset, starts, batch_size, batches, stop):
+    def put(item):
+        # give up once the consumer has stopped listening
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    try:
+        for start in starts:
+            if not put((None, dataset_slice(dataset, start, start + batch_size))):
+                return
+        put((None, None))
+    except Exception:
+        # keep the traceback so the consumer can re-raise it as it happened here
+        put((sys.exc_info(), None))
+
+def iterate_minibatches(dataset, batch_size=1, shuffle=False, rng=None, allow_partial=False, prefetch=2):
+    """
+    Yields the minibatches of rows of a dataset (a theano shared variable, numpy array or PackedPianoRoll) in order.
+    For a PackedPianoRoll the next batches are unpacked on a background thread. The other datasets are sliced
+    on the calling thread, since a slice of them is only a view.
+
+    @type  shuffle: Boolean
+    @param shuffle: Visit the batches in a random order. Each batch keeps its rows contiguous and in order,
+    so sequence datasets stay valid sequences.
+    @type  rng: numpy.random.RandomState
+    @param rng: Random generator for the batch order, defaults to numpy.random.
+    @type  allow_partial: Boolean
+    @param allow_partial: Also yield the last batch when it has fewer than batch_size rows (it is dropped otherwise).
+    @type  prefetch: Integer
+    @param prefetch: How many PackedPianoRoll batches to unpack ahead of the consumer. 0 unpacks on the calling thread.
+    """
+    length = dataset_length(dataset)
+    n_batches = length / batch_size
+    if allow_partial and length % batch_size != 0:
+        n_batches += 1
+    starts = [i * batch_size for i in xrange(n_batches)]
+    if shuffle:
+        if rng is None:
+            rng = numpy.random
+        rng.shuffle(starts)
+
+    if prefetch <= 0 or not isinstance(dataset, PackedPianoRoll):
+        for start in starts:
+            yield dataset_slice(dataset, start, start + batch_size)
+        return
+
+    batches = Queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    worker = threading.Thread(target=_prefetch_worker, args=(dataset, starts, batch_size, batches, stop))
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            error, xs = batches.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if xs is None:
+                break
+            yield xs
+    finally:
+        # also stops the worker if the consumer quits early
+        stop.set()
+        worker.join()
+
+def iterate_cost_function(function, dataset, batch_size=1, shuffle=False, rng=None, allow_partial=False, prefetch=2):
+    """
+    Applies a compiled (cost, error) function to each minibatch from iterate_minibatches,
+    yielding (cost, error, seconds) where seconds is the time spent in the function call.
+    """
+    for xs in iterate_minibatches(dataset, batch_size, shuffle, rng, allow_partial, prefetch):
+        t = time.time()
+        cost, error = function(xs)
+        yield cost, error, time.time() - t
+
 # Define the re-used loops for f_learn and f_cost
-def apply_cost_function_to_dataset(function, dataset, batch_size=1):
+def apply_cost_function_to_dataset(function, dataset, batch_size=1, shuffle=False, rng=None, allow_partial=False):
     costs = []
-    for i in xrange(len(dataset.get_value(borrow=True)) / batch_size):
-        xs = dataset.get_value(borrow=True)[i * batch_size : (i+1) * batch_size]
-#         xs = dataset[i * batch_size : (i+1) * batch_size].eval()
-        cost, error = function(xs)
+    for cost, error, _ in iterate_cost_function(function, dataset, batch_size, shuffle, rng, allow_partial):
+        costs.append([cost, error])
+    return costs
+
+def pad_sequences(sequences, dtype='float32'):
+    """
+    Stacks sequences of different lengths (2D arrays of (time, features)) into a (max_time, n_sequences, features)
+    array padded with zeros, and the (max_time, n_sequences) mask that is 1 where there is real data.
+    """
+    max_length = max(len(seq) for seq in sequences)
+    padded = numpy.zeros((max_length, len(sequences), sequences[0].shape[1]), dtype=dtype)
+    mask = numpy.zeros((max_length, len(sequences)), dtype=dtype)
+    for i, seq in enumerate(sequences):
+        padded[:len(seq), i] = seq
+        mask[:len(seq), i] = 1
+    return padded, mask
+
+def sequence_windows(datasets, window):
+    """
+    Cuts each dataset (one sequence each) into consecutive windows of at most window rows
+    (window=None keeps every sequence whole).
+    Returns a list of (dataset index, start, stop).
+    """
+    windows = []
+    for d, dataset in enumerate(datasets):
+        length = dataset_length(dataset)
+        step = window or max(length, 1)
+        windows.extend((d, start, min(start + step, length)) for start in xrange(0, length, step))
+    return windows
+
+def bucket_sequence_windows(windows, n_sequences, shuffle=False, rng=None):
+    """
+    Groups (dataset index, start, stop) windows into batches of n_sequences windows of similar length,
+    so padding them to a common length wastes as little as possible. The windows are sorted by length and
+    cut into consecutive batches.
+
+    @type  shuffle: Boolean
+    @param shuffle: Shuffle the windows within each length bucket and the order of the batches.
+    @type  rng: numpy.random.RandomState
+    @param rng: Random generator for the shuffling, defaults to numpy.random.
+    """
+    lengths = numpy.asarray([stop - start for (_, start, stop) in windows])
+    if shuffle:
+        if rng is None:
+            rng = numpy.random
+        # a random permutation first, so the stable sort leaves equal lengths in random order
+        order = rng.permutation(len(windows))
+        order = order[numpy.argsort(-lengths[order], kind='mergesort')]
+    else:
+        order = numpy.argsort(-lengths, kind='mergesort')
+    batches = [[windows[i] for i in order[start:start + n_sequences]] for start in xrange(0, len(windows), n_sequences)]
+    if shuffle:
+        rng.shuffle(batches)
+    return batches
+
+def iterate_sequence_cost_function(function, datasets, window, n_sequences, bucket=False, shuffle=False, rng=None):
+    """
+    Applies a compiled (cost, error) function taking (padded, mask) to batches of n_sequences windows of at most
+    window rows (the last window of each sequence can be shorter). With bucket the batches come from
+    bucket_sequence_windows, otherwise the windows are taken in order.
+    Yields (cost, error, frames, padded_size, seconds): the real frames in the batch, the size of the padded
+    (time, batch) grid, and the time spent in the function call.
+    """
+    windows = sequence_windows(datasets, window)
+    if bucket:
+        batches = bucket_sequence_windows(windows, n_sequences, shuffle, rng)
+    else:
+        batches = [windows[i:i + n_sequences] for i in xrange(0, len(windows), n_sequences)]
+    for batch in batches:
+        xs, mask = pad_sequences([dataset_slice(datasets[d], start, stop) for (d, start, stop) in batch])
+        t = time.time()
+        cost, error = function(xs, mask)
+        yield cost, error, sum(stop - start for (_, start, stop) in batch), mask.size, time.time() - t
+
+def iterate_stateful_cost_function(function, datasets, window, n_sequences, state_size, bucket=False, shuffle=False, rng=None):
+    """
+    Truncated BPTT over a list of sequence datasets. The sequences are split into groups of n_sequences (of
+    similar length with bucket, shuffled among equal lengths with shuffle), and each group is walked window by
+    window: batch k holds the k-th window (at most window rows) of every sequence of the group that is still going.
+    The function takes (padded, mask, state) and returns (cost, error, final state), with state a
+    (batch, state_size) array. Each sequence starts from zeros, and every window starts from the final state of
+    the previous window of its sequence.
+    Yields (cost, error, frames, padded_size, seconds) like iterate_sequence_cost_function.
+    """
+    # one whole sequence per entry, bucket_sequence_windows makes the groups
+    groups = bucket_sequence_windows(sequence_windows(datasets, None), n_sequences, shuffle, rng) if bucket else \
+        [[(d, 0, dataset_length(datasets[d])) for d in xrange(i, min(i + n_sequences, len(datasets)))] for i in xrange(0, len(datasets), n_sequences)]
+    for group in groups:
+        state = numpy.zeros((len(group), state_size), dtype='float32')
+        lengths = numpy.asarray([stop for (_, _, stop) in group])
+        for start in xrange(0, lengths.max(), window):
+            # the sequences that have not ended yet
+            going = (lengths > start).nonzero()[0]
+            stops = numpy.minimum(lengths[going], start + window)
+            xs, mask = pad_sequences([dataset_slice(datasets[group[i][0]], start, stop) for i, stop in zip(going, stops)])
+            t = time.time()
+            cost, error, state[going] = function(xs, mask, state[going])
+            yield cost, error, int((stops - start).sum()), mask.size, time.time() - t
+
+def apply_cost_function_to_sequences(function, datasets, window, n_sequences, bucket=False, shuffle=False, rng=None):
+    """
+    Like apply_cost_function_to_dataset over a list of sequence datasets, but the function takes (padded, mask)
+    for n_sequences windows at once, see iterate_sequence_cost_function.
+    """
+    costs = []
+    for cost, error, _, _, _ in iterate_sequence_cost_function(function, datasets, window, n_sequences, bucket, shuffle, rng):
         costs.append([cost, error])
     return costs
 
@@ -78,30 +258,48 @@ def download_jsb(path):
     download_file(origin, path, filename)
     unzip(os.path.join(path, filename), path)
 
-def load_mnist(path):
-    ''' Loads the mnist dataset
-
-    :type path: string
-    :param dataset: the path to the directory containing MNIST
+def save_npy(filename, array):
+    # write to a temporary file first so another job never maps a partial file
+    tmp_filename = "{0!s}.{1!s}.tmp.npy".format(filename[:-4], os.getpid())
+    try:
+        numpy.save(tmp_filename, array)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def load_npy_cache(path, name, splits, build, source=None, mmap_mode='r'):
     '''
-    mkdir_p(path)
-    
+    Returns a dictionary split -> array read from the files <name>_<split>.npy in path, opened with numpy.load(mmap_mode)
+    so processes using the same dataset share the pages. If any file is missing, or older than the source file,
+    build() is called once to make the dictionary of arrays and they are saved first. If they can't be saved
+    (a read-only or shared data directory), the arrays from build() are returned as they are.
+    '''
+    files = dict((split, os.path.join(path, "{0!s}_{1!s}.npy".format(name, split))) for split in splits)
+    fresh = all(os.path.isfile(f) for f in files.values())
+    if fresh and source is not None and os.path.isfile(source):
+        fresh = all(os.path.getmtime(f) >= os.path.getmtime(source) for f in files.values())
+    if not fresh:
+        arrays = build()
+        try:
+            for split in splits:
+                save_npy(files[split], arrays[split])
+        except (IOError, OSError) as e:
+            print "Could not cache {0!s} in {1!s} ({2!s}), using it from memory".format(name, path, e)
+            return dict((split, arrays[split]) for split in splits)
+    return dict((split, numpy.load(files[split], mmap_mode=mmap_mode)) for split in splits)
+
+_mnist_splits = ['train_x', 'train_y', 'valid_x', 'valid_y', 'test_x', 'test_y']
+
+def _mnist_source(path):
     pkl_file = os.path.join(path,'mnist.pkl')
     gzip_file = os.path.join(path,'mnist.pkl.gz')
-    
-    #check if a pkl or gz file exists
     if os.path.isfile(pkl_file):
-        data = cPickle.load(open(pkl_file, 'r'))
-    elif os.path.isfile(gzip_file):
-        data = cPickle.load(gzip.open(gzip_file, 'rb'))
-    else: #otherwise, it doesn't exist - download from lisa lab
-        download_mnist(path)
-        # Load the dataset
-        data = cPickle.load(gzip.open(gzip_file, 'rb'))
-    
-    return data
+        return pkl_file
+    return gzip_file
 
-def load_mnist_binary(path):
+def _load_mnist_pickle(path):
     pkl_file = os.path.join(path,'mnist.pkl')
     gzip_file = os.path.join(path,'mnist.pkl.gz')
     
@@ -115,109 +313,179 @@ def load_mnist_binary(path):
         # Load the dataset
         data = cPickle.load(gzip.open(gzip_file, 'rb'))
     
-    #make binary
-    data = [list(d) for d in data] 
-    data[0][0] = (data[0][0] > 0.5).astype('float32')
-    data[1][0] = (data[1][0] > 0.5).astype('float32')
-    data[2][0] = (data[2][0] > 0.5).astype('float32')
-    data = tuple([tuple(d) for d in data])
-    return data
-
-def load_piano_midi_de(path):
-    mkdir_p(path)
-    d = os.path.join(path,'Piano-midi.de')
-    if not os.path.isdir(d):
-        download_piano_midi_de(path)
-    
-    train_filenames = os.path.join(path, 'Piano-midi.de', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'Piano-midi.de', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'Piano-midi.de', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
-    
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
-    
-    return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
-    
+    (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = data
+    return {'train_x': train_x, 'train_y': train_y,
+            'valid_x': valid_x, 'valid_y': valid_y,
+            'test_x': test_x, 'test_y': test_y}
 
-def load_nottingham(path):
+def load_mnist(path, mmap_mode='r'):
+    ''' Loads the mnist dataset
+
+    The pickle is only read the first time, after that the splits are memory-mapped from .npy files next to it.
+
+    :type path: string
+    :param dataset: the path to the directory containing MNIST
+    '''
     mkdir_p(path)
-    d = os.path.join(path,'Nottingham')
-    if not os.path.isdir(d):
-        download_nottingham(path)
-    
-    train_filenames = os.path.join(path, 'Nottingham', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'Nottingham', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'Nottingham', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
     
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
+    data = load_npy_cache(path, 'mnist', _mnist_splits, lambda: _load_mnist_pickle(path), _mnist_source(path), mmap_mode)
     
-    return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
+    return (data['train_x'], data['train_y']), (data['valid_x'], data['valid_y']), (data['test_x'], data['test_y'])
 
-def load_muse(path):
-    mkdir_p(path)
-    d = os.path.join(path,'MuseData')
-    if not os.path.isdir(d):
-        download_muse(path)
-    
-    train_filenames = os.path.join(path, 'MuseData', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'MuseData', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'MuseData', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
+def load_mnist_binary(path, mmap_mode='r'):
+    (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = load_mnist(path, mmap_mode)
     
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
+    #make binary, once
+    def binarize():
+        return {'train_x': (train_x > 0.5).astype('float32'),
+                'valid_x': (valid_x > 0.5).astype('float32'),
+                'test_x': (test_x > 0.5).astype('float32')}
+    data = load_npy_cache(path, 'mnist_binary', ['train_x', 'valid_x', 'test_x'], binarize, _mnist_source(path), mmap_mode)
     
-    return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
+    return (data['train_x'], train_y), (data['valid_x'], valid_y), (data['test_x'], test_y)
+
+def _read_piano_roll(filename, r, dt):
+    return midiread(filename, r=r, dt=dt).piano_roll.astype(theano.config.floatX)
+
+def midi_cache_key(files, r, dt):
+    '''
+    Hash of everything the cached piano rolls depend on: the note range r, the time step dt, floatX,
+    and the name, size and modification time of every midi file (in order).
+    '''
+    stats = [(os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)) for f in files]
+    return hashlib.sha1(repr((tuple(r), float(dt), theano.config.floatX, stats))).hexdigest()
 
-def load_jsb(path):
+def load_midi_files(files, r=(21, 109), dt=0.3, cache_dir=None, cache_name='midi', n_jobs=1):
+    '''
+    Returns the list of piano rolls for the midi files, in the same order.
+
+    With n_jobs > 1 the files are parsed in a process pool of that many workers (None uses the cpu count).
+    When cache_dir is given, the piano rolls are written there as one packed (total_time, notes) array plus the
+    offset index of each file, and later calls with the same files, r and dt memory-map that cache instead of
+    reading any midi. If cache_dir can't be written, the parsed rolls are returned without caching them.
+    '''
+    if cache_dir is not None:
+        key = midi_cache_key(files, r, dt)
+        data_file = os.path.join(cache_dir, "{0!s}_{1!s}.npy".format(cache_name, key))
+        offsets_file = os.path.join(cache_dir, "{0!s}_{1!s}_offsets.npy".format(cache_name, key))
+        if os.path.isfile(data_file) and os.path.isfile(offsets_file):
+            data = numpy.load(data_file, mmap_mode='r')
+            offsets = numpy.load(offsets_file)
+            return [data[offsets[i]:offsets[i+1]] for i in xrange(len(files))]
+
+    rolls = list(parallel_imap(_read_piano_roll, ((f, r, dt) for f in files), n_jobs))
+
+    if cache_dir is not None:
+        offsets = numpy.cumsum([0] + [len(roll) for roll in rolls]).astype('int64')
+        if rolls:
+            data = numpy.concatenate(rolls, axis=0)
+        else:
+            data = numpy.zeros((0, r[1] - r[0]), dtype=theano.config.floatX)
+        try:
+            # the offsets last: the cache is only used once both files exist
+            save_npy(data_file, data)
+            save_npy(offsets_file, offsets)
+        except (IOError, OSError) as e:
+            print "Could not cache the piano rolls in {0!s} ({1!s}), using them from memory".format(cache_dir, e)
+    return rolls
+
+class PackedPianoRoll(object):
+    '''
+    A binary piano roll stored one bit per note (numpy.packbits along the note axis), so an 88-note time step takes
+    11 bytes instead of 352 as float32. Only the rows asked for with window() are expanded to a dense floatX array.
+    '''
+    def __init__(self, piano_roll):
+        piano_roll = numpy.asarray(piano_roll)
+        self.n_notes = piano_roll.shape[1]
+        self.bits = numpy.packbits(piano_roll > 0, axis=1)
+
+    @property
+    def shape(self):
+        return (self.bits.shape[0], self.n_notes)
+
+    def __len__(self):
+        return self.bits.shape[0]
+
+    def window(self, start, stop):
+        '''
+        The dense floatX piano roll for time steps [start, stop).
+        '''
+        return numpy.unpackbits(self.bits[start:stop], axis=1)[:, :self.n_notes].astype(theano.config.floatX)
+
+    def get_value(self, borrow=False):
+        # same accessor as a theano shared variable, expands the whole song
+        return self.window(0, len(self))
+
+# Accessors that work on theano shared datasets, numpy arrays and PackedPianoRoll
+def dataset_shape(dataset):
+    if isinstance(dataset, PackedPianoRoll):
+        return dataset.shape
+    if hasattr(dataset, 'get_value'):
+        return dataset.get_value(borrow=True).shape
+    return dataset.shape
+
+def dataset_length(dataset):
+    return dataset_shape(dataset)[0]
+
+def dataset_slice(dataset, start, stop):
+    if isinstance(dataset, PackedPianoRoll):
+        return dataset.window(start, stop)
+    if hasattr(dataset, 'get_value'):
+        return dataset.get_value(borrow=True)[start:stop]
+    return dataset[start:stop]
+
+def _load_midi_dataset(path, name, download, r=(21, 109), dt=0.3, cache=True, n_jobs=1, packed=False):
     mkdir_p(path)
-    d = os.path.join(path,'JSB Chorales')
+    d = os.path.join(path, name)
     if not os.path.isdir(d):
-        download_jsb(path)
-    
-    train_filenames = os.path.join(path, 'JSB Chorales', 'train', '*.mid')
-    valid_filenames = os.path.join(path, 'JSB Chorales', 'valid', '*.mid')
-    test_filenames = os.path.join(path, 'JSB Chorales', 'test', '*.mid')
-    train_files = glob.glob(train_filenames)
-    valid_files = glob.glob(valid_filenames)
-    test_files = glob.glob(test_filenames)
-    
-    train_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in train_files]
-    valid_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in valid_files]
-    test_datasets = [midiread(f, r=(21, 109), dt=0.3).piano_roll.astype(theano.config.floatX) for f in test_files]
-    
+        download(path)
+
+    cache_dir = d if cache else None
+    splits = []
+    for split in ['train', 'valid', 'test']:
+        files = glob.glob(os.path.join(d, split, '*.mid'))
+        rolls = load_midi_files(files, r=r, dt=dt, cache_dir=cache_dir, cache_name='piano_roll_'+split, n_jobs=n_jobs)
+        if packed:
+            rolls = [PackedPianoRoll(roll) for roll in rolls]
+        splits.append(rolls)
+    train_datasets, valid_datasets, test_datasets = splits
+
     return (train_datasets,[None]), (valid_datasets,[None]), (test_datasets,[None])
+
+def load_piano_midi_de(path, r=(21, 109), dt=0.3, cache=True, n_jobs=1, packed=False):
+    return _load_midi_dataset(path, 'Piano-midi.de', download_piano_midi_de, r, dt, cache, n_jobs, packed)
+
+def load_nottingham(path, r=(21, 109), dt=0.3, cache=True, n_jobs=1, packed=False):
+    return _load_midi_dataset(path, 'Nottingham', download_nottingham, r, dt, cache, n_jobs, packed)
+
+def load_muse(path, r=(21, 109), dt=0.3, cache=True, n_jobs=1, packed=False):
+    return _load_midi_dataset(path, 'MuseData', download_muse, r, dt, cache, n_jobs, packed)
+
+def load_jsb(path, r=(21, 109), dt=0.3, cache=True, n_jobs=1, packed=False):
+    return _load_midi_dataset(path, 'JSB Chorales', download_jsb, r, dt, cache, n_jobs, packed)
     
-def load_tfd(path):
-    data = io.loadmat(os.path.join(path, 'TFD_48x48.mat'))
-    X = cast32(data['images'])/cast32(255)
-    X = X.reshape((X.shape[0], X.shape[1] * X.shape[2]))
-    labels  = data['labs_ex'].flatten()
-    labeled = labels != -1
-    unlabeled   =   labels == -1  
-    train_X =   X[unlabeled]
-    valid_X =   X[unlabeled][:100] # Stuf
-    test_X  =   X[labeled]
+def load_tfd(path, mmap_mode='r'):
+    mat_file = os.path.join(path, 'TFD_48x48.mat')
+    def convert():
+        data = io.loadmat(mat_file)
+        X = cast32(data['images'])/cast32(255)
+        X = X.reshape((X.shape[0], X.shape[1] * X.shape[2]))
+        labels  = data['labs_ex'].flatten()
+        labeled = labels != -1
+        unlabeled   =   labels == -1  
+        return {'train_x': X[unlabeled], 'train_y': labels[unlabeled],
+                'test_x': X[labeled], 'test_y': labels[labeled]}
 
-    del data
+    data = load_npy_cache(path, 'tfd', ['train_x', 'train_y', 'test_x', 'test_y'], convert, mat_file, mmap_mode)
+    train_X =   data['train_x']
+    valid_X =   data['train_x'][:100] # Stuf
+    test_X  =   data['test_x']
 
-    return (train_X, labels[unlabeled]), (valid_X, labels[unlabeled][:100]), (test_X, labels[labeled])
+    return (train_X, data['train_y']), (valid_X, data['train_y'][:100]), (test_X, data['test_y'])
 
 
 
-def load_datasets(dataset, data_path):
+def load_datasets(dataset, data_path, packed=False):
     """
     Load the appropriate dataset as (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y) tuples.
 
@@ -225,6 +493,8 @@ def load_datasets(dataset, data_path):
     @param dataset: Name of the dataset to return.
     @type  data_path: String
     @param data_path: Location of the data directory to use.
+    @type  packed: Boolean
+    @param packed: Return the midi datasets as lists of PackedPianoRoll instead of dense arrays.
     
     @rtype:  Tuples
     @return: (train_X, train_Y), (valid_X, valid_Y), (test_X, test_Y)
@@ -243,13 +513,13 @@ def load_datasets(dataset, data_path):
     elif dataset == "tfd":
         return load_tfd(data_path)
     elif dataset == "nottingham":
-        return load_nottingham(data_path)
+        return load_nottingham(data_path, packed=packed)
     elif dataset == "muse":
-        return load_muse(data_path)
+        return load_muse(data_path, packed=packed)
     elif dataset == "pianomidi":
-        return load_piano_midi_de(data_path)
+        return load_piano_midi_de(data_path, packed=packed)
     elif dataset == "jsb":
-        return load_jsb(data_path)
+        return load_jsb(data_path, packed=packed)
     else:
         raise NotImplementedError("You requested to load dataset {0!s}, please choose MNIST*, TFD, nottingham, muse, pianomidi, jsb.".format(dataset))
 
@@ -300,33 +570,52 @@ def shuffle_data(X, Y=None, rng=None):
     
 
         
-def dataset1_indices(labels, classes=10):
-    #Creates an ordering of indices for this MNIST label series (normally expressed as y in dataset) that makes the numbers go in order 0-9....
-    sequence = []
-    pool = []
-    for _ in range(classes):
-        pool.append([])
-    #organize the indices into groups by label
-    for i in range(len(labels)):
-        pool[labels[i]].append(i)
-    #draw from each pool (also with the random number insertions) until one is empty
-    stop = False
+def _class_pools(labels, classes, rng=None):
+    """
+    Groups the example indices by label. Returns (order, counts, starts) where the indices with label c are
+    order[starts[c] : starts[c]+counts[c]], in dataset order, or shuffled within the class if rng is given.
+    """
+    labels = numpy.asarray(labels).astype('int64')
+    if rng is None:
+        order = numpy.argsort(labels, kind='mergesort')
+    else:
+        order = numpy.lexsort((rng.random_sample(len(labels)), labels))
+    counts = numpy.bincount(labels, minlength=classes)
+    starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+    return order, counts[:classes], starts[:classes]
+
+def _draw_from_pools(order, counts, starts, class_sequence):
+    """
+    Takes one index from the pool of each class in class_sequence in turn, last index of the pool first,
+    stopping at the first class whose pool is empty. class_sequence has to be longer than the number of examples.
+    """
+    class_sequence = numpy.asarray(class_sequence, dtype='int64')
+    # how many times each class was drawn before this position
+    occurrence = numpy.empty(len(class_sequence), dtype='int64')
+    for c in xrange(len(counts)):
+        drawn = class_sequence == c
+        occurrence[drawn] = numpy.arange(drawn.sum())
+    exhausted = (occurrence >= counts[class_sequence]).nonzero()[0]
+    if len(exhausted) > 0:
+        class_sequence = class_sequence[:exhausted[0]]
+        occurrence = occurrence[:exhausted[0]]
+    return order[starts[class_sequence] + counts[class_sequence] - 1 - occurrence]
+
+def _cyclic_indices(labels, cycle, classes, name, rng=None):
+    # draws the classes in cycle over and over until one runs out
+    order, counts, starts = _class_pools(labels, classes, rng)
     #check if there is an empty class
-    for n in pool:
-        if len(n) == 0:
-            stop = True
-            print
-            print "stopped early from dataset1 sequencing - missing some class of labels"
-            print
-    while not stop:
-        #for i in range(classes)+range(classes-2,0,-1):
-        for i in range(classes):
-            if not stop:
-                if len(pool[i]) == 0: #stop the procedure if you are trying to pop from an empty list
-                    stop = True
-                else:
-                    sequence.append(pool[i].pop())
-    return sequence
+    if (counts == 0).any():
+        print
+        print "stopped early from {0!s} sequencing - missing some class of labels".format(name)
+        print
+        return numpy.zeros((0,), dtype='int64')
+    return _draw_from_pools(order, counts, starts, numpy.resize(numpy.asarray(cycle), len(order)+1))
+
+def dataset1_indices(labels, classes=10, rng=None):
+    #Creates an ordering of indices for this MNIST label series (normally expressed as y in dataset) that makes the numbers go in order 0-9....
+    #rng shuffles which example of each class is used where
+    return _cyclic_indices(labels, range(classes), classes, 'dataset1', rng)
         
 #order sequentially, but randomly choose when a 1, 4, or 8.
 def dataset2_indices(labels, rng, classes=10, change_prob=.5):
@@ -364,143 +653,74 @@ def dataset2_indices(labels, rng, classes=10, change_prob=.5):
     return sequence
 
 #order sequentially up then down 0-9-9-0....
-def dataset2a_indices(labels, classes=10):
-    sequence = []
-    pool = []
-    for _ in range(classes):
-        pool.append([])
-    #organize the indices into groups by label
-    for i in range(len(labels)):
-        pool[labels[i]].append(i)
-    #draw from each pool (also with the random number insertions) until one is empty
-    stop = False
-    #check if there is an empty class
-    for n in pool:
-        if len(n) == 0:
-            stop = True
-            print
-            print "stopped early from dataset2a sequencing - missing some class of labels"
-            print
-    while not stop:
-        for i in range(classes)+range(classes-1,-1,-1):
-            if not stop:
-                if len(pool[i]) == 0: #stop the procedure if you are trying to pop from an empty list
-                    stop = True
-                else:
-                    sequence.append(pool[i].pop())
-    return sequence
+def dataset2a_indices(labels, classes=10, rng=None):
+    return _cyclic_indices(labels, range(classes)+range(classes-1,-1,-1), classes, 'dataset2a', rng)
 
 #order sequentially up then down but only for 0-1-1-0-0-1.....
-def dataset2b_indices(labels, classes=2):
-    sequence = []
-    pool = []
-    for _ in range(classes):
-        pool.append([])
-    #organize the indices into groups by label
-    for i in range(len(labels)):
-        if labels[i] < len(pool):
-            pool[labels[i]].append(i)
-    #draw from each pool (also with the random number insertions) until one is empty
-    stop = False
-    #check if there is an empty class
-    for n in pool:
-        if len(n) == 0:
-            stop = True
-            print
-            print "stopped early from dataset2b sequencing - missing some class of labels"
-            print
-    while not stop:
-        for i in range(classes)+range(classes-1,-1,-1):
-            if not stop:
-                if len(pool[i]) == 0: #stop the procedure if you are trying to pop from an empty list
-                    stop = True
-                else:
-                    sequence.append(pool[i].pop())
-    return sequence
+def dataset2b_indices(labels, classes=2, rng=None):
+    labels = numpy.asarray(labels).astype('int64')
+    # only the examples of the first classes are used
+    kept = (labels < classes).nonzero()[0]
+    return kept[_cyclic_indices(labels[kept], range(classes)+range(classes-1,-1,-1), classes, 'dataset2b', rng)]
                 
 
-def dataset3_indices(labels, classes=10):
-    sequence = []
-    pool = []
-    for _ in range(classes):
-        pool.append([])
-    #organize the indices into groups by label
-    for i in range(len(labels)):
-        pool[labels[i]].append(i)
-    #draw from each pool (also with the random number insertions) until one is empty
-    stop = False
+def dataset3_indices(labels, classes=10, rng=None):
+    # every other pass over the classes draws a 4 for the 1, an 8 for the 4 and a 1 for the 8
+    swapped = {1:4, 4:8, 8:1}
+    cycle = range(classes) + [swapped.get(i, i) for i in range(classes)]
+    order, counts, starts = _class_pools(labels, classes, rng)
     #check if there is an empty class
-    for n in pool:
-        if len(n) == 0:
-            stop = True
-            print "stopped early from dataset3 sequencing - missing some class of labels"
-    a = False
-    while not stop:
-        for i in range(classes):
-            if not stop:
-                n=i
-                if i == 1 and a:
-                    n = 4
-                elif i == 4 and a:
-                    n = 8
-                elif i == 8 and a:
-                    n = 1
-                if len(pool[n]) == 0: #stop the procedure if you are trying to pop from an empty list
-                    stop = True
-                else:
-                    sequence.append(pool[n].pop())
-        a = not a
-            
-    return sequence
+    if (counts == 0).any():
+        print "stopped early from dataset3 sequencing - missing some class of labels"
+        return numpy.zeros((0,), dtype='int64')
+    return _draw_from_pools(order, counts, starts, numpy.resize(numpy.asarray(cycle), len(order)+1))
+
+def _dataset4_next(s, classes):
+    # the next number from the last three, using extra bits of parity
+    if s[-3] % 2 == 1:
+        first_bit = (s[-2] - s[-3])%classes
+    else:
+        first_bit = (s[-2] + s[-3])%classes
+    if first_bit % 2 == 1:
+        second_bit = (s[-1] - first_bit)%classes
+    else:
+        second_bit = (s[-1] + first_bit)%classes
+    if second_bit % 2 == 1:
+        return (s[-1] - second_bit)%classes
+    else:
+        return (s[-1] + second_bit + 1)%classes
 
 # extra bits of parity
-def dataset4_indices(labels, classes=10):
-    def even(n):
-        return n%2==0
-    def odd(n):
-        return not even(n)
-    sequence = []
-    pool = []
-    for _ in range(classes):
-        pool.append([])
-    #organize the indices into groups by label
-    for i in range(len(labels)):
-        pool[labels[i]].append(i)
-    #draw from each pool (also with the random number insertions) until one is empty
-    stop = False
+def dataset4_indices(labels, classes=10, rng=None):
+    order, counts, starts = _class_pools(labels, classes, rng)
+    length = len(order) + 1
     #check if there is an empty class
-    for n in pool:
-        if len(n) == 0:
-            stop = True
-            print "stopped early from dataset4 sequencing - missing some class of labels"
+    stop = (counts == 0).any()
+    if stop:
+        print "stopped early from dataset4 sequencing - missing some class of labels"
+    if stop:
+        # only the starting 0,1,2 is drawn, up to the first of them that is missing
+        return _draw_from_pools(order, counts, starts, [0,1,2])
+    # the next number only depends on the last three, so the sequence becomes periodic
+    # as soon as three numbers repeat - generate up to there and tile the period
     s = [0,1,2]
-    sequence.append(pool[0].pop())
-    sequence.append(pool[1].pop())
-    sequence.append(pool[2].pop())
-    while not stop:
-        if odd(s[-3]):
-            first_bit = (s[-2] - s[-3])%classes
-        else:
-            first_bit = (s[-2] + s[-3])%classes
-        if odd(first_bit):
-            second_bit = (s[-1] - first_bit)%classes
-        else:
-            second_bit = (s[-1] + first_bit)%classes
-        if odd(second_bit):
-            next_num = second_bit = (s[-1] - second_bit)%classes
-        else:
-            next_num = second_bit = (s[-1] + second_bit + 1)%classes 
-            
-        if len(pool[next_num]) == 0: #stop the procedure if you are trying to pop from an empty list
-            stop = True
-        else:
-            s.append(next_num)
-            sequence.append(pool[next_num].pop())
-            
-    return sequence
+    seen = {(0,1,2): 0}
+    while len(s) < length:
+        s.append(_dataset4_next(s, classes))
+        state = tuple(s[-3:])
+        if state in seen:
+            start = seen[state] + 3
+            period = s[start:]
+            s.extend(numpy.resize(numpy.asarray(period), max(0, length - len(s))).tolist())
+            break
+        seen[state] = len(s) - 3
+    return _draw_from_pools(order, counts, starts, s[:length])
 
 
 def sequence_mnist_data(train_X, train_Y, valid_X, valid_Y, test_X, test_Y, dataset=1, rng=None, one_hot=False):
+    # an rng from the caller is handed to the index builders, so each (re-)sequencing draws the examples of
+    # every class in a seeded random order; without one the examples keep their fixed order
+    pool_rng = rng
     if rng is None:
         rng = numpy.random
         rng.seed(1)
@@ -523,21 +743,21 @@ def sequence_mnist_data(train_X, train_Y, valid_X, valid_Y, test_X, test_Y, data
     # Find the order of MNIST data going from 0-9 repeating if the first dataset
     order_i = True
     if dataset == 1:
-        train_ordered_indices = dataset1_indices(train_Y.get_value(borrow=True))
-        valid_ordered_indices = dataset1_indices(valid_Y.get_value(borrow=True))
-        test_ordered_indices = dataset1_indices(test_Y.get_value(borrow=True))
+        train_ordered_indices = dataset1_indices(train_Y.get_value(borrow=True), rng=pool_rng)
+        valid_ordered_indices = dataset1_indices(valid_Y.get_value(borrow=True), rng=pool_rng)
+        test_ordered_indices = dataset1_indices(test_Y.get_value(borrow=True), rng=pool_rng)
     elif dataset == 2:
-        train_ordered_indices = dataset2a_indices(train_Y.get_value(borrow=True))
-        valid_ordered_indices = dataset2a_indices(valid_Y.get_value(borrow=True))
-        test_ordered_indices = dataset2a_indices(test_Y.get_value(borrow=True))
+        train_ordered_indices = dataset2a_indices(train_Y.get_value(borrow=True), rng=pool_rng)
+        valid_ordered_indices = dataset2a_indices(valid_Y.get_value(borrow=True), rng=pool_rng)
+        test_ordered_indices = dataset2a_indices(test_Y.get_value(borrow=True), rng=pool_rng)
     elif dataset == 3:
-        train_ordered_indices = dataset3_indices(train_Y.get_value(borrow=True))
-        valid_ordered_indices = dataset3_indices(valid_Y.get_value(borrow=True))
-        test_ordered_indices = dataset3_indices(test_Y.get_value(borrow=True))
+        train_ordered_indices = dataset3_indices(train_Y.get_value(borrow=True), rng=pool_rng)
+        valid_ordered_indices = dataset3_indices(valid_Y.get_value(borrow=True), rng=pool_rng)
+        test_ordered_indices = dataset3_indices(test_Y.get_value(borrow=True), rng=pool_rng)
     elif dataset == 4:
-        train_ordered_indices = dataset4_indices(train_Y.get_value(borrow=True))
-        valid_ordered_indices = dataset4_indices(valid_Y.get_value(borrow=True))
-        test_ordered_indices = dataset4_indices(test_Y.get_value(borrow=True))
+        train_ordered_indices = dataset4_indices(train_Y.get_value(borrow=True), rng=pool_rng)
+        valid_ordered_indices = dataset4_indices(valid_Y.get_value(borrow=True), rng=pool_rng)
+        test_ordered_indices = dataset4_indices(test_Y.get_value(borrow=True), rng=pool_rng)
     else:
         order_i = False
     
@@ -553,12 +773,10 @@ def sequence_mnist_data(train_X, train_Y, valid_X, valid_Y, test_X, test_Y, data
     ###############################################################################################################
     if one_hot:
         #construct the numpy matrix of representations from y
-        train = numpy.array([[1 if i==y else 0 for i in range(10)] for y in train_Y.get_value(borrow=True)],dtype="float32")
-        train_X.set_value(train)
-        valid = numpy.array([[1 if i==y else 0 for i in range(10)] for y in valid_Y.get_value(borrow=True)],dtype="float32")
-        valid_X.set_value(valid)
-        test = numpy.array([[1 if i==y else 0 for i in range(10)] for y in test_Y.get_value(borrow=True)],dtype="float32")
-        test_X.set_value(test)
+        eye = numpy.eye(10, dtype="float32")
+        train_X.set_value(eye[numpy.asarray(train_Y.get_value(borrow=True)).astype('int64')])
+        valid_X.set_value(eye[numpy.asarray(valid_Y.get_value(borrow=True)).astype('int64')])
+        test_X.set_value(eye[numpy.asarray(test_Y.get_value(borrow=True)).astype('int64')])
     
 def sequence_mnist_not_shared(train_X, train_Y, valid_X, valid_Y, test_X, test_Y, dataset=1):        
     def set_xy_indices(x, y, indices):
@@ -0,0 +1,159 @@
+'''
+@author: Markus Beissinger
+University of Pennsylvania, 2014-2015
+
+Persistent on-disk cache for compiled theano functions.
+
+The optimized graphs of the compiled functions (their FunctionMakers) are pickled together with the shared
+variables they were built on, in a file named by a hash of the model's architecture configuration (layers,
+walkbacks, sizes, activations, cost function, floatX, device...) and of the source code that builds the graphs. When a
+model with the same configuration and code starts again, the optimized graphs are unpickled without being
+re-optimized, and each function is linked again on the storage of the new model's shared variables
+(FunctionMaker.create with their containers), so the graph optimization step is skipped entirely.
+
+Used by RNN_GSN (rnngsn.py), SEN (sen.py) and the Story scripts, which key it on the state arguments that
+change their graphs (turned off with state.cache_functions = 0).
+'''
+
+import os
+import sys
+import time
+import cPickle
+import hashlib
+import inspect
+
+import theano
+
+import logger as log
+from utils import make_time_units_string
+
+# pickling a theano graph with scan in it recurses very deep
+_RECURSION_LIMIT = 50000
+
+
+def describe_callable(fn):
+    '''
+    A string that identifies an activation or cost function well enough to key a cache on.
+    Named options (like 'tanh') are used as-is, lambdas are described by their bytecode and the names they reference.
+    '''
+    if fn is None or isinstance(fn, basestring):
+        return str(fn)
+    code = getattr(fn, 'func_code', None)
+    if code is None:
+        return str(fn)
+    return "{0!s}:{1!s}:{2!r}:{3!r}".format(getattr(fn, '__name__', ''), code.co_code.encode('hex'), code.co_consts, code.co_names)
+
+
+def source_digest(*objects):
+    '''
+    A hash of the source files defining the given modules, classes or functions, so editing the code
+    that builds a graph (a cost, noise or update rule...) changes the cache key.
+    '''
+    digest = hashlib.sha1()
+    for filename in sorted(set(os.path.abspath(inspect.getsourcefile(obj)) for obj in objects)):
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _rebind(maker, swap):
+    '''
+    Links the function of an unpickled FunctionMaker, with the shared variables in swap replaced by their values
+    (old -> new shared variable): the new function reads and updates the new variables' storage.
+    '''
+    storage = []
+    for spec in maker.inputs:
+        if spec.variable in swap:
+            storage.append(swap[spec.variable].container)
+        else:
+            storage.append(getattr(spec, 'value', None))
+    return maker.create(storage)
+
+
+def make_config_key(config):
+    '''
+    Hashes the architecture configuration (a dictionary of plain values) together with the theano settings
+    that change the compiled graph: floatX, the device it was compiled for (a cpu graph loaded by a gpu run
+    would silently stay on the cpu), the mode and optimizer, the BLAS it links against and the theano version.
+    '''
+    config = dict(config)
+    config['floatX'] = theano.config.floatX
+    config['device'] = theano.config.device
+    config['mode'] = str(theano.config.mode)
+    config['optimizer'] = theano.config.optimizer
+    config['blas.ldflags'] = theano.config.blas.ldflags
+    config['theano_version'] = theano.__version__
+    return hashlib.sha1(repr(sorted(config.items()))).hexdigest()
+
+
+class FunctionCache(object):
+    '''
+    Loads and saves named groups of compiled theano functions for one architecture configuration.
+    '''
+    def __init__(self, config, cache_dir=None, logger=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(theano.config.compiledir, 'function_cache')
+        self.cache_dir = cache_dir
+        self.key = make_config_key(config)
+        self.logger = logger
+        log.mkdir(self.cache_dir)
+
+    def filename(self, name):
+        return os.path.join(self.cache_dir, "{0!s}_{1!s}.pkl".format(name, self.key))
+
+    def load(self, name, shared_variables):
+        '''
+        Returns the dictionary of functions saved under name, rebound to shared_variables
+        (in the same order they were given to save), or None on a cache miss.
+        '''
+        filename = self.filename(name)
+        if not os.path.isfile(filename):
+            log.maybeLog(self.logger, "No cached functions for {0!s} at {1!s}".format(name, filename))
+            return None
+        t = time.time()
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, _RECURSION_LIMIT))
+        # theano re-optimizes unpickled graphs by default, which is exactly what the cache is there to avoid
+        old_reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(filename, 'rb') as f:
+                makers, cached_shared = cPickle.load(f)
+            if len(cached_shared) != len(shared_variables):
+                log.maybeLog(self.logger, "Cached functions in {0!s} were built on different parameters, recompiling.".format(filename))
+                return None
+            swap = dict(zip(cached_shared, shared_variables))
+            rebound = {}
+            for fname, maker in makers.items():
+                rebound[fname] = _rebind(maker, swap)
+        except Exception as e:
+            log.maybeLog(self.logger, "Could not load cached functions from {0!s} ({1!s}), recompiling.".format(filename, e))
+            return None
+        finally:
+            theano.config.reoptimize_unpickled_function = old_reoptimize
+            sys.setrecursionlimit(old_limit)
+        log.maybeLog(self.logger, "Loaded cached functions {0!s} in {1!s}".format(sorted(rebound.keys()), make_time_units_string(time.time() - t)))
+        return rebound
+
+    def save(self, name, functions, shared_variables):
+        '''
+        Pickles the optimized graphs of a dictionary of compiled functions together with the shared variables
+        they should be rebound to.
+        Writes to a temporary file first so concurrent jobs never see a partial cache file.
+        '''
+        filename = self.filename(name)
+        tmp_filename = "{0!s}.{1!s}.tmp".format(filename, os.getpid())
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, _RECURSION_LIMIT))
+        try:
+            with open(tmp_filename, 'wb') as f:
+                makers = dict((fname, function.maker) for fname, function in functions.items())
+                cPickle.dump((makers, list(shared_variables)), f, protocol=cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, filename)
+            log.maybeLog(self.logger, "Saved compiled functions to {0!s}".format(filename))
+        except Exception as e:
+            log.maybeLog(self.logger, "Could not cache compiled functions to {0!s} ({1!s})".format(filename, e))
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+        finally:
+            sys.setrecursionlimit(old_limit)
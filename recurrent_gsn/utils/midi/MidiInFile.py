@@ -35,9 +35,9 @@ class MidiInFile:
     
     """
 
-    def __init__(self, outStream, infile):
+    def __init__(self, outStream, infile, use_mmap=False):
         # these could also have been mixins, would that be better? Nah!
-        self.raw_in = RawInstreamFile(infile)
+        self.raw_in = RawInstreamFile(infile, use_mmap)
         self.parser = MidiFileParser(self.raw_in, outStream)
 
 
@@ -51,5 +51,10 @@ class MidiInFile:
     def setData(self, data=''):
         "Sets the data from a plain string"
         self.raw_in.setData(data)
+
+
+    def close(self):
+        "Releases the input file if it was memory mapped"
+        self.raw_in.close()
     
     
@@ -14,9 +14,16 @@ class MidiOutFile(MidiOutStream):
     """
 
 
-    def __init__(self, raw_out=''):
+    def __init__(self, raw_out='', streaming=False):
 
-        self.raw_out = RawOutstreamFile(raw_out)
+        """
+        raw_out: file name or file object to write to.
+        streaming: write the events of each track straight to raw_out 
+        and patch the track length in when the track ends, so the 
+        file is never held in memory.
+        """
+        self.streaming = streaming
+        self.raw_out = RawOutstreamFile(raw_out, streaming)
         MidiOutStream.__init__(self)
         
     
@@ -34,6 +41,27 @@ class MidiOutFile(MidiOutStream):
         trk.writeSlice(slc)
         
     
+    def channel_events(self, deltas, statuses, data1, data2):
+        """
+        Writes a batch of two data byte channel events (note on/off,
+        aftertouch, controllers) to the current track in one go.
+        deltas: relative times of the events
+        statuses: status bytes, including the channel
+        data1, data2: 0-127
+        """
+        var_cache = {}
+        chunks = []
+        for delta, status, d1, d2 in zip(deltas, statuses, data1, data2):
+            var = var_cache.get(delta)
+            if var is None:
+                var = var_cache[delta] = writeVar(delta)
+            chunks.append(var + fromBytes([status, d1, d2]))
+        self._current_track_buffer.writeSlice(''.join(chunks))
+        if chunks:
+            self._absolute_time += sum(deltas)
+            self._relative_time = deltas[-1]
+
+    
     #####################
     ## Midi events
 
@@ -220,7 +248,15 @@ class MidiOutFile(MidiOutStream):
         """
         n_track: number of track
         """
-        self._current_track_buffer = RawOutstreamFile()
+        if self.streaming:
+            # write the header now with a length to patch in later
+            raw = self.raw_out
+            raw.writeSlice(TRACK_HEADER)
+            self._track_length_position = raw.tell()
+            raw.writeBew(0, 4)
+            self._current_track_buffer = raw
+        else:
+            self._current_track_buffer = RawOutstreamFile()
         self.reset_time()
         self._current_track += 1
 
@@ -230,6 +266,11 @@ class MidiOutFile(MidiOutStream):
         Writes the track to the buffer.
         """
         raw = self.raw_out
+        if self.streaming:
+            raw.writeSlice(writeVar(self.rel_time()) + fromBytes([META_EVENT, END_OF_TRACK, 0]))
+            track_start = self._track_length_position + 4
+            raw.patchBew(self._track_length_position, raw.tell() - track_start, 4)
+            return
         raw.writeSlice(TRACK_HEADER)
         track_data = self._current_track_buffer.getvalue()
         # wee need to know size of track data.
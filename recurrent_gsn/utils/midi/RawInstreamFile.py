@@ -1,11 +1,16 @@
 # -*- coding: ISO-8859-1 -*-
 
 # standard library imports
+import mmap
 from types import StringType
-from struct import unpack
+from struct import Struct
 
 # custom import
-from DataTypeConverters import readBew, readVar, varLen
+from DataTypeConverters import varLen
+
+# precompiled big endian word decoders, read straight out of the data
+_BEW = {1:Struct('>B'), 2:Struct('>H'), 4:Struct('>L')}
+_BYTE = _BEW[1]
 
 
 class RawInstreamFile:
@@ -18,7 +23,7 @@ class RawInstreamFile:
     
     """
     
-    def __init__(self, infile=''):
+    def __init__(self, infile='', use_mmap=False):
         """ 
         If 'file' is a string we assume it is a path and read from 
         that file.
@@ -26,12 +31,25 @@ class RawInstreamFile:
         close it.
         Midi files are usually pretty small, so it should be safe to 
         copy them into memory.
+        If use_mmap is true and 'file' is a path, the file is memory 
+        mapped instead of copied, and words are decoded in place. 
+        Call close() when done to release the mapping.
         """
+        self._mapped_file = None
         if infile:
             if isinstance(infile, StringType):
                 infile = open(infile, 'rb')
-                self.data = infile.read()
-                infile.close()
+                if use_mmap:
+                    try:
+                        self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+                        self._mapped_file = infile
+                    except (ValueError, EnvironmentError):
+                        # empty files can't be mapped
+                        self.data = infile.read()
+                        infile.close()
+                else:
+                    self.data = infile.read()
+                    infile.close()
             else:
                 # don't close the f
                 self.data = infile.read()
@@ -45,7 +63,17 @@ class RawInstreamFile:
     
     def setData(self, data=''):
         "Sets the data from a string."
+        self.close()
         self.data = data
+
+
+    def close(self):
+        "Releases the memory mapped file, if any"
+        if self._mapped_file is not None:
+            self.data.close()
+            self._mapped_file.close()
+            self._mapped_file = None
+            self.data = ''
     
     # cursor operations
 
@@ -79,7 +107,10 @@ class RawInstreamFile:
         Reads n bytes of date from the current cursor position.
         Moves cursor if move_cursor is true
         """
-        return readBew(self.nextSlice(n_bytes, move_cursor))
+        value = _BEW[n_bytes].unpack_from(self.data, self.cursor)[0]
+        if move_cursor:
+            self.moveCursor(n_bytes)
+        return value
 
 
     def readVarLen(self):
@@ -88,7 +119,15 @@ class RawInstreamFile:
         Moves cursor if move_cursor is true
         """
         MAX_VARLEN = 4 # Max value varlen can be
-        var = readVar(self.nextSlice(MAX_VARLEN, 0))
+        data = self.data
+        c = self.cursor
+        end = min(c + MAX_VARLEN, len(data))
+        var = 0
+        while c < end:
+            byte = _BYTE.unpack_from(data, c)[0]
+            var = (var << 7) + (byte & 0x7F)
+            c += 1
+            if not 0x80 & byte: break # stop after last byte
         # only move cursor the actual bytes in varlen
         self.moveCursor(varLen(var))
         return var
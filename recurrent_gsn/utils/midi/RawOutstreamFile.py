@@ -17,9 +17,26 @@ class RawOutstreamFile:
     
     """
 
-    def __init__(self, outfile=''):
-        self.buffer = StringIO()
+    def __init__(self, outfile='', streaming=False):
+        """
+        In streaming mode every slice is written straight to outfile 
+        (a path or a seekable file object) instead of being buffered, 
+        and patchBew can go back to fill in values that were not known 
+        when they were written.
+        """
         self.outfile = outfile
+        self.streaming = streaming
+        self._opened = False
+        if streaming:
+            if not outfile:
+                raise ValueError('Streaming needs a file name or a seekable file object')
+            if isinstance(outfile, StringType):
+                self.buffer = open(outfile, 'wb')
+                self._opened = True
+            else:
+                self.buffer = outfile
+        else:
+            self.buffer = StringIO()
 
 
     # native data reading functions
@@ -40,9 +57,28 @@ class RawOutstreamFile:
         var = self.writeSlice(writeVar(value))
 
 
+    def tell(self):
+        "Returns the current write position"
+        return self.buffer.tell()
+
+
+    def patchBew(self, position, value, length=1):
+        "Overwrites a big endian word at position, then continues at the end"
+        self.buffer.seek(position)
+        self.buffer.write(writeBew(value, length))
+        self.buffer.seek(0, 2)
+
+
     def write(self):
         "Writes to disc"
-        if self.outfile:
+        if self.streaming:
+            # everything is on disc already
+            if self._opened:
+                if not self.buffer.closed:
+                    self.buffer.close()
+            else:
+                self.buffer.flush()
+        elif self.outfile:
             if isinstance(self.outfile, StringType):
                 outfile = open(self.outfile, 'wb')
                 outfile.write(self.getvalue())
@@ -8,25 +8,58 @@
 from MidiOutFile import MidiOutFile
 from MidiInFile import MidiInFile
 from MidiOutStream import MidiOutStream
+from constants import NOTE_ON, NOTE_OFF
 
 import numpy
 
 
+def notes_to_piano_roll(notes, r=(21, 109), dt=0.2):
+  """
+  Builds the piano-roll for a list of [pitch, onset, offset] notes (times in seconds).
+  Each note covers frames ceil(onset/dt) up to ceil(offset/dt); the frames are marked with a
+  difference array (+1 at the onset, -1 at the offset) and a cumulative sum over time.
+  """
+  notes = numpy.asarray(notes, dtype='float64').reshape((-1, 3))
+  length = int(numpy.ceil(notes[:, 2].max() / dt))
+  onsets = numpy.ceil(notes[:, 1] / dt).astype('int64')
+  offsets = numpy.ceil(notes[:, 2] / dt).astype('int64')
+  # pitches below r[0] wrap around to the top columns, like negative indices did
+  pitches = notes[:, 0].astype('int64') - r[0]
+  sounding = onsets < offsets
+  onsets, offsets, pitches = onsets[sounding], offsets[sounding], pitches[sounding]
+
+  changes = numpy.zeros((length + 1, r[1]-r[0]), dtype='int64')
+  numpy.add.at(changes, (onsets, pitches), 1)
+  numpy.add.at(changes, (offsets, pitches), -1)
+  return (numpy.cumsum(changes[:length], axis=0) > 0).astype('float64')
+
+
 class midiread(MidiOutStream):
   def __init__(self, filename, r=(21, 109), dt=0.2):
     self.notes = []
+    self._last_note = {}  # pitch -> index in self.notes of the latest note_on with that pitch
     self._tempo = 500000
     self.beat = 0
     self.time = 0.0
 
-    midi_in = MidiInFile(self, filename)
-    midi_in.read()
+    midi_in = MidiInFile(self, filename, use_mmap=True)
+    try:
+      midi_in.read()
+    finally:
+      midi_in.close()
     self.notes = [n for n in self.notes if n[2] is not None]  # purge incomplete notes
 
-    length = int(numpy.ceil(max(zip(*self.notes)[2]) / dt))  # create piano-roll
-    self.piano_roll = numpy.zeros((length, r[1]-r[0]))
-    for n in self.notes:
-      self.piano_roll[int(numpy.ceil(n[1]/dt)) : int(numpy.ceil(n[2]/dt)), n[0]-r[0]] = 1
+    self.r = r
+    self.piano_roll = self.piano_roll_at(dt)
+
+  def piano_roll_at(self, dt, r=None):
+    """
+    Rasterizes the parsed notes at time step dt (and note range r, defaults to the one given
+    to the constructor), so several quantizations can be built from one parse.
+    """
+    if r is None:
+      r = self.r
+    return notes_to_piano_roll(self.notes, r, dt)
 
   def abs_time_in_seconds(self):
     return self.time + self._tempo * (self.abs_time() - self.beat) * 1e-6 / self.div
@@ -40,13 +73,13 @@ class midiread(MidiOutStream):
     self.div = division
 
   def note_on(self, channel=0, note=0x40, velocity=0x40):
+    self._last_note[note] = len(self.notes)
     self.notes.append([note, self.abs_time_in_seconds(), None])
 
   def note_off(self, channel=0, note=0x40, velocity=0x40):
-    i = len(self.notes) - 1
-    while i >= 0 and self.notes[i][0] != note:
-      i -= 1
-    if i >= 0 and self.notes[i][2] is None:
+    # only the latest note_on of this pitch can be closed, like the backwards search it replaces
+    i = self._last_note.get(note)
+    if i is not None and self.notes[i][2] is None:
       self.notes[i][2] = self.abs_time_in_seconds()
 
   def sysex_event(*args):
@@ -56,31 +89,33 @@ class midiread(MidiOutStream):
     pass
 
 
-def midiwrite(filename, piano_roll, r=(21, 109), dt=0.2, patch=0):
-  midi = MidiOutFile(filename)
+def midiwrite(filename, piano_roll, r=(21, 109), dt=0.2, patch=0, streaming=False):
+  # streaming writes the track straight to the file instead of buffering it
+  midi = MidiOutFile(filename, streaming=streaming)
   midi.header(division=100)
   midi.start_of_track() 
   midi.patch_change(channel=0, patch=patch)
-  t = 0
-  samples = [i.nonzero()[0] + r[0] for i in piano_roll]
-
-  for i in xrange(len(samples)):
-    for f in samples[i]:
-      if i==0 or f not in samples[i-1]:
-        midi.update_time(t)
-        midi.note_on(channel=0, note=f, velocity=90)
-        t = 0
-    
-    t += int(dt*200)
-
-    for f in samples[i]:
-      if i==len(samples)-1 or f not in samples[i+1]:
-        midi.update_time(t)
-        midi.note_off(channel=0, note=f, velocity=0)
-        t = 0
-      
+  step = int(dt*200)
+
+  # +1 where a note starts in frame i, -1 where a note playing in frame i-1 stops
+  roll = numpy.asarray(piano_roll) != 0
+  padded = numpy.zeros((roll.shape[0]+2, roll.shape[1]), dtype='int8')
+  padded[1:-1] = roll
+  changes = numpy.diff(padded, axis=0)
+  on_frames, on_notes = (changes == 1).nonzero()
+  off_frames, off_notes = (changes == -1).nonzero()
+
+  # in each frame the note_ons come first (at the start of the frame), then the note_offs (at its end),
+  # each group by ascending pitch
+  slots = numpy.concatenate([2*on_frames, 2*off_frames - 1])
+  notes = numpy.concatenate([on_notes, off_notes]) + r[0]
+  order = numpy.lexsort((notes, slots))
+  ticks = numpy.concatenate([on_frames, off_frames])[order] * step
+  deltas = numpy.diff(numpy.concatenate([[0], ticks]))
+  statuses = numpy.concatenate([numpy.repeat(NOTE_ON, len(on_frames)), numpy.repeat(NOTE_OFF, len(off_frames))])[order]
+  velocities = numpy.concatenate([numpy.repeat(90, len(on_frames)), numpy.repeat(0, len(off_frames))])[order]
+  midi.channel_events(deltas.tolist(), statuses.tolist(), notes[order].tolist(), velocities.tolist())
+
   midi.update_time(0)
   midi.end_of_track()
   midi.eof()
-
-
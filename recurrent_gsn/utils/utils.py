@@ -7,6 +7,9 @@ https://github.com/yaoli/GSN
 
 As well as Pylearn2.utils
 '''
+import multiprocessing
+import threading
+import traceback
 import numpy
 import theano
 import theano.tensor as T
@@ -201,6 +204,82 @@ def closest_to_square_factors(n):
     return int(test), int(n/test)
 
 
+# the function each pool worker runs, set once when the worker starts
+_pool_function = None
+
+def _pool_init(function):
+    global _pool_function
+    _pool_function = function
+
+def _pool_apply(args):
+    return _pool_function(*args)
+
+def check_poolable(function, n_jobs):
+    """
+    Raises ValueError if function is a compiled theano function and n_jobs asks for a process pool.
+    The pool workers are forked, and a forked child can't use the parent's CUDA context or the shared
+    variables on the device (and forking after BLAS threads have started can deadlock). Pools need numpy
+    callables such as likelihood_estimation.GemmParzen or CSL.get_CSL_fn_independent_Bernoulli_streaming.
+    """
+    if n_jobs is not None and n_jobs <= 1:
+        return
+    if isinstance(function, theano.compile.function_module.Function):
+        raise ValueError("Can't run the compiled theano function {0!s} in a pool of forked processes, "
+                         "use n_jobs=1 or a numpy evaluator".format(function.name))
+
+def parallel_imap(function, args_list, n_jobs=None):
+    """
+    Applies function to each tuple of arguments in args_list across a pool of n_jobs processes,
+    yielding the results in order. The function is handed to the workers when they start
+    (inherited through fork), so large arrays it closes over are not pickled for every task.
+    With more than one job the function has to be plain numpy/python: compiled theano functions
+    don't work in forked workers (see check_poolable), and neither do closures calling them.
+    n_jobs=1 runs everything in this process.
+    """
+    check_poolable(function, n_jobs)
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs <= 1:
+        for args in args_list:
+            yield function(*args)
+        return
+    pool = multiprocessing.Pool(processes=n_jobs, initializer=_pool_init, initargs=(function,))
+    try:
+        for result in pool.imap(_pool_apply, args_list):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+class BackgroundJob(threading.Thread):
+    """
+    A daemon thread running function(*args). After it is joined, error is None if function returned,
+    or the formatted traceback of the exception it raised.
+    """
+    def __init__(self, function, args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.function(*self.args)
+        except Exception:
+            self.error = traceback.format_exc()
+
+def run_in_background(function, *args):
+    """
+    Runs function(*args) on a BackgroundJob thread and returns the started thread.
+    Nothing is copied for it: hand it snapshots (e.g. get_value() of the parameters, and a NumpyGSN built on them)
+    rather than theano shared variables this process goes on changing. numpy releases the GIL inside its
+    BLAS calls, so a numpy sampler keeps running alongside the compiled training functions.
+    """
+    job = BackgroundJob(function, args)
+    job.start()
+    return job
+
 
 ##################
 # PYLEARN2 UTILS #